@@ -3,76 +3,498 @@
 """
 Prints images in the terminal.
 
-Usage: catimg.py <image...>
+Usage: catimg.py [--grid] <image...>
+
+Between images: enter shows the next one, p or backspace the previous one,
+space shows all the remaining ones and q quits. The next images are decoded
+and rendered in the background while one is displayed.
+
+With --grid, pages of thumbnails are shown instead of single images and the
+keys move by pages. Thumbnails are kept in ~/.cache/catimg/thumbnails.
+
+Animated GIF, PNG and WebP images are played until they end or a key is
+pressed, redrawing only the cells that change between frames.
 """
 
-from dataclasses import dataclass
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import collections
+import hashlib
 import os
-from typing import Tuple, List
+import pathlib
+import queue
+import select
 import PIL.Image
 import sys
 import termios
+import threading
+import time
+from .images import cell_grid, make_thumbnail, open_image, resize_frame
 
-TERMINAL_ASPECT_RATIO = 1/2
+# the upper half of a cell, drawn in the foreground colour over the background colour of the lower half
+UPPER_HALF_BLOCK = "\u2580"
+FG_CELL = "\033[38;2;%d;%d;%dm" + UPPER_HALF_BLOCK
+BG_CELL = "\033[48;2;%d;%d;%dm" + UPPER_HALF_BLOCK
+FG_BG_CELL = "\033[38;2;%d;%d;%d;48;2;%d;%d;%dm" + UPPER_HALF_BLOCK
+RESET = "\033[0m"
+# images rendered ahead of the displayed one
+PREFETCH_COUNT = 3
+FRAME_CACHE_BYTES = 64 * 1024 * 1024
+# frames of an animation decoded ahead of the displayed one
+FRAMES_AHEAD = 8
+MIN_FRAME_DURATION_MS = 10
+DEFAULT_FRAME_DURATION_MS = 100
+# how long a key may wait while the next frame is decoded
+KEY_POLL_SECONDS = 0.05
+# the cells a thumbnail fits in, in grid mode
+THUMBNAIL_SIZE = (24, 10)
+THUMBNAIL_CACHE_BYTES = 64 * 1024 * 1024
 
 def ansi_color(r, g, b):
   return "\033[38;2;{};{};{}m".format(r, g, b)
 
-@dataclass
-class Image:
-  original: PIL.Image
-  size: Tuple[int, int]
-  pixels: List[Tuple[int, int, int]]
-
-def open_image(path, hint_resize):
-  img = PIL.Image.open(path)
-  
-  (letterbox_width, letterbox_height) = (0, 0)
-  (fit_width, fit_height) = hint_resize
-  (img_width, img_height) = img.size
-  r = min(fit_width / img_width * TERMINAL_ASPECT_RATIO, fit_height / img_height)
-  letterbox_width = int(img_width * r * 2)
-  letterbox_height = int(img_height * r * 2)
-  hint_resize = (letterbox_width, letterbox_height)
-  resized_img = img.resize(hint_resize, PIL.Image.Resampling.BICUBIC)
-
-  return Image(img, resized_img.size, list(resized_img.getdata()))
+def row_cells(data, width, y):
+  # the (upper, lower) colours of the cells of line y of a grid of width cells, in rgb bytes
+  row_size = width * 3
+  top = data[2 * y * row_size:(2 * y + 1) * row_size]
+  bottom = data[(2 * y + 1) * row_size:(2 * y + 2) * row_size]
+  return zip(zip(top[0::3], top[1::3], top[2::3]), zip(bottom[0::3], bottom[1::3], bottom[2::3]))
+
+def render_cells(cells):
+  # every cell shows two pixels, the upper one in the foreground colour of a half block and
+  # the lower one in the background colour. Colours are only sent when they change
+  parts = []
+  (fg, bg) = (None, None)
+  for (cell_fg, cell_bg) in cells:
+    if cell_fg != fg:
+      parts.append(FG_BG_CELL % (cell_fg + cell_bg) if cell_bg != bg else FG_CELL % cell_fg)
+    else:
+      parts.append(BG_CELL % cell_bg if cell_bg != bg else UPPER_HALF_BLOCK)
+    (fg, bg) = (cell_fg, cell_bg)
+  return "".join(parts)
+
+def render_image(image, fit_size):
+  (width, height) = cell_grid(image.size, fit_size)
+  grid = image.resized
+  if grid.size != (width, height * 2):
+    grid = grid.resize((width, height * 2), PIL.Image.Resampling.BOX)
+  data = grid.tobytes()
+  # reset before each line ends, a background colour would fill the new line when the terminal scrolls
+  return "".join(render_cells(row_cells(data, width, y)) + RESET + "\n" for y in range(height))
 
 def print_image(image, fit_size):
-  (fit_width, fit_height) = fit_size
-  (img_width, img_height) = image.size
-
-  (letterbox_width, letterbox_height) = (0, 0)
-  r = min(fit_width / img_width * TERMINAL_ASPECT_RATIO, fit_height / img_height)
-  letterbox_width = int(img_width / TERMINAL_ASPECT_RATIO * r)
-  letterbox_height = int(img_height * r)
-  txt = ''
-  for y in range(letterbox_height):
-    for x in range(letterbox_width):
-      sx = x * img_width // letterbox_width
-      sy = y * img_height // letterbox_height
-      (r, g, b, *_) = image.pixels[sy * image.size[0] + sx]
-      txt += ansi_color(r, g, b) + "█"
-    txt += "\n"
-  txt += "\033[0m"
-  print(txt, end='')
+  print(render_image(image, fit_size), end='')
 
 
-def print_image_file(path, fit_size):
+def render_image_file(path, fit_size):
+  # the image with its header line, encoded to be written as is
   image = open_image(path, fit_size)
-  print(">", path, "{}x{}".format(*image.original.size))
-  print_image(image, fit_size)
+  return ("> {} {}x{}\n".format(path, *image.size) + render_image(image, fit_size)).encode()
+
+def print_image_file(path, fit_size):
+  sys.stdout.buffer.write(render_image_file(path, fit_size))
+  sys.stdout.flush()
+
+
+def is_animated(path):
+  with PIL.Image.open(path) as img:
+    return getattr(img, 'is_animated', False)
+
+def render_changes(previous, current, width, height):
+  # redraws the cells of current that differ from previous, or all of them if previous is None.
+  # The cursor is on the line below the image before and after
+  parts = ["\033[%dA" % height]
+  line = 0
+  for y in range(height):
+    row = slice(2 * y * width * 3, (2 * y + 2) * width * 3)
+    if previous is not None and previous[row] == current[row]:
+      continue
+    cells = list(row_cells(current, width, y))
+    if previous is None:
+      runs = [(0, width)]
+    else:
+      changed = [x for (x, (cell, previous_cell)) in enumerate(zip(cells, row_cells(previous, width, y))) if cell != previous_cell]
+      # consecutive changed cells are drawn at once, after a single cursor move
+      runs = []
+      for x in changed:
+        if runs and runs[-1][1] == x:
+          runs[-1] = (runs[-1][0], x + 1)
+        else:
+          runs.append((x, x + 1))
+    if y > line:
+      parts.append("\033[%dB" % (y - line))
+      line = y
+    for (start, end) in runs:
+      parts.append("\033[%dG" % (start + 1) + render_cells(cells[start:end]))
+  parts.append(RESET + "\033[%dB\r" % (height - line))
+  return "".join(parts)
+
+def decode_frames(path, grid_size, loops):
+  # yields the frames of an animated image resized to grid_size, with their durations in seconds.
+  # They are played loops times, forever if loops is 0. The grids of the first loop are kept to
+  # replay the next ones without decoding them again, unless they take too much memory
+  with PIL.Image.open(path) as img:
+    def frames():
+      for index in range(img.n_frames):
+        img.seek(index)
+        duration = img.info.get('duration') or 0
+        # like browsers, frames without a usable duration are shown for 100ms
+        if duration <= MIN_FRAME_DURATION_MS:
+          duration = DEFAULT_FRAME_DURATION_MS
+        yield (resize_frame(img, grid_size).tobytes(), duration / 1000)
+
+    kept = []
+    loop = 0
+    while loops == 0 or loop < loops:
+      if loop > 0 and kept is not None:
+        yield from kept
+      else:
+        for frame in frames():
+          if loop == 0 and kept is not None:
+            kept.append(frame)
+            if len(kept) * len(frame[0]) > FRAME_CACHE_BYTES:
+              kept = None
+          yield frame
+      loop += 1
+
+
+class AnimationPlayer:
+  """
+  Plays an animated image over its first frame, printed by render_image just
+  above the cursor. A worker thread decodes the frames ahead, they are shown
+  at the durations of the file and only the cells that changed since the last
+  shown frame are redrawn. A frame whose time is over is dropped when the next
+  one is ready, so that a slow terminal skips frames instead of slowing the
+  animation down. Frames decoded late are shown as soon as they are ready,
+  frames depend on the previous ones and cannot be skipped by the decoder.
+  """
+
+  def __init__(self, path, fit_size, loops=None):
+    self.path = path
+    with PIL.Image.open(path) as img:
+      (self.width, self.height) = cell_grid(img.size, fit_size)
+      # a missing loop count means the animation is played once, 0 that it loops forever
+      self.loops = img.info.get('loop', 1) if loops is None else loops
+    self.frames = queue.Queue(FRAMES_AHEAD)
+    self.stopped = threading.Event()
+    self.shown = 0
+    self.dropped = 0
+
+  def decode(self):
+    try:
+      for frame in decode_frames(self.path, (self.width, self.height * 2), self.loops):
+        if not self.offer(frame):
+          return
+    finally:
+      self.offer(None)
+
+  def offer(self, frame):
+    # queues frame unless the player stopped, returns whether it did
+    while not self.stopped.is_set():
+      try:
+        self.frames.put(frame, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def play(self, tty_in):
+    # plays until the animation ends or a key is pressed, returns the key or None
+    key = None
+    previous = None
+    start = due = time.monotonic()
+    worker = threading.Thread(target=self.decode, daemon=True)
+    worker.start()
+    try:
+      while True:
+        try:
+          frame = self.frames.get(timeout=KEY_POLL_SECONDS)
+        except queue.Empty:
+          # a frame may take long to decode, keys are read meanwhile
+          (ready, _, _) = select.select([tty_in], [], [], 0)
+          if ready:
+            key = os.read(tty_in, 1)
+            break
+          continue
+        if frame is None:
+          break
+        (grid, duration) = frame
+        if self.shown == 0:
+          # the first frame is the one already printed
+          previous = grid
+          self.shown += 1
+          due += duration
+          continue
+        if time.monotonic() > due + duration and not self.frames.empty():
+          self.dropped += 1
+          due += duration
+          continue
+        # waits for the time of the frame, or a key
+        (ready, _, _) = select.select([tty_in], [], [], max(0, due - time.monotonic()))
+        if ready:
+          key = os.read(tty_in, 1)
+          break
+        sys.stdout.buffer.write(render_changes(previous, grid, self.width, self.height).encode())
+        sys.stdout.flush()
+        previous = grid
+        self.shown += 1
+        due += duration
+    finally:
+      self.stopped.set()
+    elapsed = time.monotonic() - start
+    print("> {} frames in {:.1f}s, {:.1f} fps, {} dropped".format(self.shown, elapsed, self.shown / elapsed if elapsed else 0, self.dropped))
+    return key
+
+
+class FrameCache:
+  """
+  Rendered images, least recently used first, up to max_bytes. Frames are
+  keyed by path, modification time and terminal size, a changed file or a
+  resized terminal gets new frames.
+  """
+
+  def __init__(self, max_bytes=FRAME_CACHE_BYTES):
+    self.max_bytes = max_bytes
+    self.frames = collections.OrderedDict()
+    self.size = 0
+    self.lock = threading.Lock()
+
+  @staticmethod
+  def key(path, fit_size):
+    return (os.path.abspath(path), os.stat(path).st_mtime_ns, fit_size)
+
+  def get(self, key):
+    with self.lock:
+      frame = self.frames.get(key)
+      if frame is not None:
+        self.frames.move_to_end(key)
+      return frame
+
+  def put(self, key, frame):
+    with self.lock:
+      if key in self.frames:
+        self.size -= len(self.frames.pop(key))
+      self.frames[key] = frame
+      self.size += len(frame)
+      # the newest frame is kept even if it is over the limit alone
+      while self.size > self.max_bytes and len(self.frames) > 1:
+        (_, evicted) = self.frames.popitem(last=False)
+        self.size -= len(evicted)
+
+
+class Slideshow:
+  """
+  Displays images one at a time, decoding and rendering the next ones in
+  worker threads in the meantime. PIL releases the GIL while it decodes and
+  resizes, which is most of the work on large images.
+  """
+
+  def __init__(self, paths, prefetch_count=PREFETCH_COUNT, cache=None):
+    self.paths = paths
+    self.prefetch_count = prefetch_count
+    self.cache = FrameCache() if cache is None else cache
+    self.pool = ThreadPoolExecutor(max(1, min(prefetch_count, os.cpu_count() or 1)))
+    self.pending = {}
+    self.lock = threading.Lock()
+
+  def close(self):
+    self.pool.shutdown(wait=False, cancel_futures=True)
+
+  def render(self, key, path, fit_size):
+    frame = render_image_file(path, fit_size)
+    self.cache.put(key, frame)
+    with self.lock:
+      self.pending.pop(key, None)
+    return frame
+
+  def request(self, i, fit_size):
+    # returns the frame of image i if it is cached, else a future of it
+    path = self.paths[i]
+    key = FrameCache.key(path, fit_size)
+    with self.lock:
+      # checked under the lock, a worker caches its frame before it is no longer pending
+      frame = self.cache.get(key)
+      if frame is not None:
+        return frame
+      if key not in self.pending:
+        self.pending[key] = self.pool.submit(self.render, key, path, fit_size)
+      return self.pending[key]
+
+  def frame(self, i, fit_size):
+    # the frame of image i, once the next ones are being rendered
+    frame = self.request(i, fit_size)
+    # the previous image is kept rendered too, to step back instantly
+    for j in [*range(i+1, i+1+self.prefetch_count), i-1]:
+      if 0 <= j < len(self.paths):
+        # a neighbour that was removed fails when it is shown, not while image i is
+        try:
+          self.request(j, fit_size)
+        except OSError:
+          pass
+    return frame if isinstance(frame, bytes) else frame.result()
+
+
+class ThumbnailCache:
+  """
+  Thumbnails on disk, one file per thumbnail named after a hash of the path,
+  modification time and size of the image and of the thumbnail size. Reading
+  a thumbnail updates the modification time of its file, the least recently
+  used ones are removed once the cache is over max_bytes.
+  """
+
+  def __init__(self, directory=None, max_bytes=THUMBNAIL_CACHE_BYTES):
+    if directory is None:
+      directory = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'catimg', 'thumbnails')
+    self.directory = pathlib.Path(directory)
+    self.max_bytes = max_bytes
+    self.written = False
+
+  @staticmethod
+  def key(path, fit_size):
+    stat = os.stat(path)
+    return hashlib.sha1(repr((os.path.abspath(path), stat.st_mtime_ns, stat.st_size, fit_size)).encode()).hexdigest()
+
+  def get(self, key):
+    file = self.directory / key
+    try:
+      data = file.read_bytes()
+      os.utime(file)
+    except OSError:
+      return None
+    # a header line with the size of the grid, then its rgb bytes
+    (header, _, pixels) = data.partition(b"\n")
+    try:
+      (width, height) = (int(v) for v in header.split())
+    except ValueError:
+      return None
+    return ((width, height), pixels) if len(pixels) == width * height * 3 else None
+
+  def put(self, key, thumbnail):
+    ((width, height), pixels) = thumbnail
+    self.directory.mkdir(parents=True, exist_ok=True)
+    # written aside then renamed, other catimg processes may read it meanwhile
+    temp_file = self.directory / (key + ".{}.tmp".format(os.getpid()))
+    temp_file.write_bytes(b"%d %d\n" % (width, height) + pixels)
+    os.replace(temp_file, self.directory / key)
+    self.written = True
+
+  def evict(self):
+    # the cache only grows when thumbnails are written, it is not listed otherwise
+    if not self.written:
+      return
+    files = []
+    for entry in os.scandir(self.directory):
+      try:
+        stat = entry.stat()
+      except OSError:
+        continue
+      files.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    size = sum(file_size for (_, file_size, _) in files)
+    for (_, file_size, path) in sorted(files):
+      if size <= self.max_bytes:
+        break
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+      size -= file_size
+    self.written = False
+
+
+class ContactSheet:
+  """
+  Lays out thumbnails of many images per screen, with their file names. The
+  thumbnails are read from a ThumbnailCache, the missing ones are decoded in
+  worker processes, on all cores, while the thumbnails of the next page are
+  decoded in the background.
+  """
+
+  def __init__(self, paths, cache=None, thumbnail_size=THUMBNAIL_SIZE):
+    self.paths = paths
+    self.cache = ThumbnailCache() if cache is None else cache
+    self.thumbnail_size = thumbnail_size
+    # started on the first missing thumbnail, folders already cached do not need it
+    self.pool = None
+    self.pending = {}
+
+  def close(self):
+    # thumbnails decoded for a page that was not shown are kept too
+    for (key, future) in self.pending.items():
+      if future.done() and not future.cancelled() and future.exception() is None:
+        self.cache.put(key, future.result())
+    if self.pool is not None:
+      self.pool.shutdown(wait=False, cancel_futures=True)
+    self.cache.evict()
+
+  def layout(self, fit_size):
+    # the number of (columns, rows) of thumbnails on a page, each one has a line for its name
+    (width, height) = self.thumbnail_size
+    return (max(1, (fit_size[0] + 1) // (width + 1)), max(1, (fit_size[1] - 1) // (height + 1)))
+
+  def request(self, path):
+    # returns the cache key of the thumbnail of path and the thumbnail, or a future of it
+    key = ThumbnailCache.key(path, self.thumbnail_size)
+    if key in self.pending:
+      return (key, self.pending[key])
+    thumbnail = self.cache.get(key)
+    if thumbnail is not None:
+      return (key, thumbnail)
+    if self.pool is None:
+      self.pool = ProcessPoolExecutor(os.cpu_count())
+    self.pending[key] = self.pool.submit(make_thumbnail, path, self.thumbnail_size)
+    return (key, self.pending[key])
+
+  def thumbnails(self, paths):
+    requests = [self.request(path) for path in paths]
+    thumbnails = []
+    for (key, thumbnail) in requests:
+      if isinstance(thumbnail, Future):
+        thumbnail = thumbnail.result()
+        # the same image may be twice on a page, with a single future
+        if self.pending.pop(key, None) is not None:
+          self.cache.put(key, thumbnail)
+      thumbnails.append(thumbnail)
+    return thumbnails
+
+  def page(self, start, fit_size):
+    # the page of the images from start, returns it encoded and the number of images on it
+    (columns, rows) = self.layout(fit_size)
+    count = columns * rows
+    paths = self.paths[start:start+count]
+    thumbnails = self.thumbnails(paths)
+    for path in self.paths[start+count:start+2*count]:
+      # like in slideshows, a removed image fails when its page is shown
+      try:
+        self.request(path)
+      except OSError:
+        pass
+
+    (width, height) = self.thumbnail_size
+    lines = ["> {}-{} of {}\n".format(start + 1, start + len(paths), len(self.paths))]
+    for row in range(0, len(paths), columns):
+      for y in range(height):
+        parts = []
+        for thumbnail in thumbnails[row:row+columns]:
+          if y >= thumbnail[0][1] // 2:
+            parts.append(" " * (width + 1))
+            continue
+          ((grid_width, _), pixels) = thumbnail
+          # centered in its column
+          margin = (width - grid_width) // 2
+          parts.append(" " * margin + render_cells(row_cells(pixels, grid_width, y)) + RESET + " " * (width - grid_width - margin + 1))
+        lines.append("".join(parts).rstrip() + "\n")
+      lines.append(" ".join(os.path.basename(path)[:width].ljust(width) for path in paths[row:row+columns]).rstrip() + "\n")
+    return ("".join(lines).encode(), len(paths))
 
 
 def main():
   sys.argv.pop(0)
+  grid = '--grid' in sys.argv
+  if grid:
+    sys.argv.remove('--grid')
   if len(sys.argv) == 0:
-    print("Usage: catimg.py <image...>")
+    print("Usage: catimg.py [--grid] <image...>")
     sys.exit(1)
 
-  print_size = os.get_terminal_size()
-  print_size = (print_size[0], print_size[1]-2)
-
   image_files = []
   for file_name in sys.argv:
     if os.path.isfile(file_name):
@@ -83,6 +505,7 @@ def main():
     else:
       print("catimg.py: {}: No such file or directory".format(file_name), file=sys.stderr)
     
+  viewer = ContactSheet(image_files) if grid else Slideshow(image_files)
   try:
     tty_in = os.open("/dev/tty", os.O_RDONLY)
     tty_out = os.open("/dev/tty", os.O_WRONLY)
@@ -93,10 +516,27 @@ def main():
     termios.tcsetattr(tty_in, termios.TCSAFLUSH, new_term)
 
     continue_without_prompt = False
-    for (i, img_file) in enumerate(image_files):
-      print_image_file(img_file, print_size)
-      while not continue_without_prompt and i != len(image_files)-1:
-        usr_cmd = os.read(tty_in, 1)
+    i = 0
+    while i < len(image_files):
+      # read at every image, frames are rendered again if the terminal was resized
+      print_size = os.get_terminal_size()
+      print_size = (print_size[0], print_size[1]-2)
+      # i is the first image shown, shown the number of images on the screen
+      if grid:
+        (frame, shown) = viewer.page(i, print_size)
+      else:
+        (frame, shown) = (viewer.frame(i, print_size), 1)
+      sys.stdout.buffer.write(frame)
+      sys.stdout.flush()
+      # a key pressed during an animation is handled like one pressed after it.
+      # Without prompts, animations are played once
+      key = None
+      if not grid and is_animated(image_files[i]):
+        key = AnimationPlayer(image_files[i], print_size, 1 if continue_without_prompt else None).play(tty_in)
+      step = shown
+      while not continue_without_prompt and i + shown < len(image_files):
+        usr_cmd = key if key is not None else os.read(tty_in, 1)
+        key = None
         if usr_cmd == b'q':
           return
         elif usr_cmd == b'\n' or usr_cmd == b'\r':
@@ -104,8 +544,13 @@ def main():
         elif usr_cmd == b' ':
           continue_without_prompt = True
           break
+        elif usr_cmd in (b'p', b'\x7f', b'\x08') and i > 0:
+          step = -min(i, shown)
+          break
+      i += step
 
   finally:
+    viewer.close()
     termios.tcsetattr(tty_out, termios.TCSAFLUSH, old_term)
 
 
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for catimg, run on a synthetic photo-like image or a given image.
+
+Usage:
+python -m catimg.benchmark render [--image <path>] [--sizes 80x24,200x60] [--runs N]
+python -m catimg.benchmark slideshow [--images N] [--image-size WxH] [--think S]
+python -m catimg.benchmark decode [--image <path>] [--image-size WxH] [--sizes 80x24,200x60] [--runs N]
+python -m catimg.benchmark animation [--image <path>] [--sizes 80x24,200x60] [--runs N]
+python -m catimg.benchmark grid [--images N] [--image-size WxH]
+"""
+
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import PIL.Image
+import PIL.ImageDraw
+import PIL.ImageFilter
+from . import __main__ as catimg, images
+
+def make_image(size, seed=0):
+  # smooth gradients with noise, so that colours change at almost every cell like on photos
+  rng = random.Random(seed)
+  (width, height) = size
+  gradient = PIL.Image.linear_gradient('L').resize(size)
+  noise = PIL.Image.frombytes('L', size, rng.randbytes(width * height)).filter(PIL.ImageFilter.GaussianBlur(2))
+  return PIL.Image.merge('RGB', (gradient, noise, gradient.rotate(90)))
+
+def legacy_print_image(image, fit_size):
+  # print_image before half blocks, one full block and one escape per cell, returns the text
+  pixels = list(image.resized.tobytes())
+  pixels = list(zip(pixels[0::3], pixels[1::3], pixels[2::3]))
+  (fit_width, fit_height) = fit_size
+  (img_width, img_height) = image.resized.size
+  r = min(fit_width / img_width * images.TERMINAL_ASPECT_RATIO, fit_height / img_height)
+  letterbox_width = int(img_width / images.TERMINAL_ASPECT_RATIO * r)
+  letterbox_height = int(img_height * r)
+  txt = ''
+  for y in range(letterbox_height):
+    for x in range(letterbox_width):
+      sx = x * img_width // letterbox_width
+      sy = y * img_height // letterbox_height
+      (r, g, b, *_) = pixels[sy * img_width + sx]
+      txt += catimg.ansi_color(r, g, b) + "█"
+    txt += "\n"
+  txt += "\033[0m"
+  return txt
+
+def time_render(render, image, fit_size, runs):
+  times = []
+  for _ in range(runs):
+    start = time.perf_counter()
+    text = render(image, fit_size)
+    times.append(time.perf_counter() - start)
+  return (min(times), len(text.encode()))
+
+def render_pixels(image, fit_size, half_blocks):
+  (width, height) = images.cell_grid(image.size, fit_size)
+  return width * height * (2 if half_blocks else 1)
+
+def bench_render(args):
+  with tempfile.TemporaryDirectory() as temp_dir:
+    path = args.image
+    if path is None:
+      path = os.path.join(temp_dir, 'image.png')
+      make_image((1600, 1200)).save(path)
+    print(f"image {PIL.Image.open(path).size[0]}x{PIL.Image.open(path).size[1]}")
+    for fit_size in args.sizes:
+      image = images.open_image(path, fit_size)
+      (legacy_time, legacy_bytes) = time_render(legacy_print_image, image, fit_size, args.runs)
+      (new_time, new_bytes) = time_render(catimg.render_image, image, fit_size, args.runs)
+      # half blocks print twice as many pixels on the same cells
+      (legacy_pixels, new_pixels) = (render_pixels(image, fit_size, False), render_pixels(image, fit_size, True))
+      print(f"  {fit_size[0]:>4}x{fit_size[1]:<4} legacy {legacy_time*1000:7.1f}ms {legacy_bytes/1e3:8.1f}KB {legacy_bytes/legacy_pixels:5.1f}B/pixel"
+            f"   half blocks {new_time*1000:7.1f}ms {new_bytes/1e3:8.1f}KB {new_bytes/new_pixels:5.1f}B/pixel"
+            f"   per pixel x{legacy_time/legacy_pixels/(new_time/new_pixels):.1f} faster")
+
+def bench_slideshow(args):
+  # steps through images forward then back, the user looking at each one for args.think seconds,
+  # and measures how long each step waits for its frame
+  fit_size = args.sizes[0]
+  with tempfile.TemporaryDirectory() as temp_dir:
+    paths = []
+    for i in range(args.images):
+      paths.append(os.path.join(temp_dir, f"image{i}.jpg"))
+      make_image(args.image_size, seed=i).save(paths[-1], quality=90)
+    order = list(range(args.images)) + list(reversed(range(args.images - 1)))
+    print(f"{args.images} images of {args.image_size[0]}x{args.image_size[1]}, {fit_size[0]}x{fit_size[1]} terminal, {args.think}s per image")
+
+    waits = []
+    for i in order:
+      start = time.perf_counter()
+      catimg.render_image_file(paths[i], fit_size)
+      waits.append(time.perf_counter() - start)
+      time.sleep(args.think)
+    print(f"  on keypress  wait avg {sum(waits)/len(waits)*1000:8.1f}ms  max {max(waits)*1000:8.1f}ms")
+
+    slideshow = catimg.Slideshow(paths)
+    waits = []
+    for i in order:
+      start = time.perf_counter()
+      slideshow.frame(i, fit_size)
+      waits.append(time.perf_counter() - start)
+      time.sleep(args.think)
+    slideshow.close()
+    print(f"  prefetched   wait avg {sum(waits)/len(waits)*1000:8.1f}ms  max {max(waits)*1000:8.1f}ms  (first image {waits[0]*1000:.1f}ms)")
+
+def legacy_open_image(path, hint_resize):
+  # open_image before reduced decoding, a full decode resized to twice the cell grid
+  img = PIL.Image.open(path)
+  (fit_width, fit_height) = hint_resize
+  (img_width, img_height) = img.size
+  r = min(fit_width / img_width * images.TERMINAL_ASPECT_RATIO, fit_height / img_height)
+  resized_img = img.resize((int(img_width * r * 2), int(img_height * r * 2)), PIL.Image.Resampling.BICUBIC).convert('RGB')
+  return images.Image(img, img.size, resized_img)
+
+# the peak rss is read from VmHWM, ru_maxrss would include the peak of the parent process
+# since linux preserves it across execve
+DECODE_CODE = """
+import sys, time
+from catimg import benchmark, images, __main__ as catimg
+(opener, path, width, height) = (sys.argv[1], sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+start = time.perf_counter()
+if opener != 'none':
+  image = getattr(benchmark if opener == 'legacy_open_image' else images, opener)(path, (width, height))
+  catimg.render_image(image, (width, height))
+elapsed = time.perf_counter() - start
+with open('/proc/self/status') as status:
+  peak_kb = next(int(line.split()[1]) for line in status if line.startswith('VmHWM:'))
+print(elapsed, peak_kb)
+"""
+
+def measure_decode(opener, path, fit_size, runs):
+  # opens and renders the image in fresh interpreters, returns the best time and the peak rss in KB
+  results = []
+  for _ in range(runs):
+    output = subprocess.run([sys.executable, '-c', DECODE_CODE, opener, path, str(fit_size[0]), str(fit_size[1])],
+                            env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(__file__))),
+                            capture_output=True, text=True, check=True).stdout.split()
+    results.append((float(output[0]), int(output[1])))
+  return (min(t for (t, rss) in results), min(rss for (t, rss) in results))
+
+def bench_decode(args):
+  with tempfile.TemporaryDirectory() as temp_dir:
+    paths = [args.image] if args.image else []
+    if not paths:
+      image = make_image(args.image_size)
+      for extension in ['jpg', 'png']:
+        paths.append(os.path.join(temp_dir, f"image.{extension}"))
+        image.save(paths[-1])
+    (_, base_rss) = measure_decode('none', paths[0], args.sizes[0], 1)
+    for path in paths:
+      size = PIL.Image.open(path).size
+      print(f"{os.path.basename(path)} {size[0]}x{size[1]}, peak memory above the interpreter's")
+      for fit_size in args.sizes:
+        (legacy_time, legacy_rss) = measure_decode('legacy_open_image', path, fit_size, args.runs)
+        (new_time, new_rss) = measure_decode('open_image', path, fit_size, args.runs)
+        print(f"  {fit_size[0]:>4}x{fit_size[1]:<4} full decode {legacy_time*1000:8.1f}ms {(legacy_rss-base_rss)/1024:7.1f}MB"
+              f"   reduced {new_time*1000:8.1f}ms {(new_rss-base_rss)/1024:7.1f}MB   x{legacy_time/new_time:.1f} faster")
+
+def make_animation(size, frames=30):
+  # a ball crossing a photo-like background, most cells do not change between frames
+  background = make_image(size)
+  images = []
+  for i in range(frames):
+    image = background.copy()
+    x = i * size[0] // frames
+    PIL.ImageDraw.Draw(image).ellipse([x, size[1] // 3, x + size[0] // 8, size[1] // 3 + size[0] // 8], fill=(230, 200, 40))
+    images.append(image)
+  return images
+
+def bench_animation(args):
+  # renders every frame of an animation in full and only the cells that changed since the previous one
+  with tempfile.TemporaryDirectory() as temp_dir:
+    path = args.image
+    if path is None:
+      path = os.path.join(temp_dir, 'animation.gif')
+      images = make_animation((640, 400))
+      images[0].save(path, save_all=True, append_images=images[1:], duration=40, loop=0)
+    with PIL.Image.open(path) as img:
+      print(f"{os.path.basename(path)} {img.size[0]}x{img.size[1]}, {img.n_frames} frames")
+    for fit_size in args.sizes:
+      player = catimg.AnimationPlayer(path, fit_size, loops=1)
+      grids = [grid for (grid, _) in catimg.decode_frames(path, (player.width, player.height * 2), 1)]
+      (full_time, diff_time) = (float('inf'), float('inf'))
+      for _ in range(args.runs):
+        start = time.perf_counter()
+        full = [catimg.render_changes(None, grid, player.width, player.height).encode() for grid in grids[1:]]
+        full_time = min(full_time, time.perf_counter() - start)
+        start = time.perf_counter()
+        diff = [catimg.render_changes(previous, grid, player.width, player.height).encode() for (previous, grid) in zip(grids, grids[1:])]
+        diff_time = min(diff_time, time.perf_counter() - start)
+      frames = len(grids) - 1
+      (full_bytes, diff_bytes) = (sum(map(len, full)) / frames, sum(map(len, diff)) / frames)
+      print(f"  {fit_size[0]:>4}x{fit_size[1]:<4} full {full_time/frames*1000:6.2f}ms {full_bytes/1e3:8.1f}KB/frame"
+            f"   changed cells {diff_time/frames*1000:6.2f}ms {diff_bytes/1e3:8.1f}KB/frame   x{full_bytes/diff_bytes:.1f} less output")
+
+def bench_grid(args):
+  # thumbnails of a folder of images, one after the other in this process as the slideshow
+  # would decode them, in worker processes with an empty cache, then read from the cache
+  with tempfile.TemporaryDirectory() as temp_dir:
+    paths = []
+    for i in range(args.images):
+      paths.append(os.path.join(temp_dir, f"image{i}.jpg"))
+      make_image(args.image_size, seed=i).save(paths[-1], quality=90)
+    print(f"{args.images} images of {args.image_size[0]}x{args.image_size[1]}, {os.cpu_count()} cores")
+
+    start = time.perf_counter()
+    for path in paths:
+      images.make_thumbnail(path, catimg.THUMBNAIL_SIZE)
+    sequential_time = time.perf_counter() - start
+    print(f"  sequential         {sequential_time*1000:8.1f}ms")
+
+    cache = catimg.ThumbnailCache(os.path.join(temp_dir, 'thumbnails'))
+    for label in ["parallel, no cache", "cached"]:
+      sheet = catimg.ContactSheet(paths, cache)
+      start = time.perf_counter()
+      sheet.thumbnails(paths)
+      elapsed = time.perf_counter() - start
+      sheet.close()
+      print(f"  {label:<18} {elapsed*1000:8.1f}ms   x{sequential_time/elapsed:.1f} faster")
+
+BENCHMARKS = {
+  'render': bench_render,
+  'slideshow': bench_slideshow,
+  'decode': bench_decode,
+  'animation': bench_animation,
+  'grid': bench_grid,
+}
+
+def main():
+  parser = argparse.ArgumentParser(description="catimg benchmarks")
+  parser.add_argument('benchmark', choices=BENCHMARKS.keys())
+  parser.add_argument('--image', default=None)
+  parser.add_argument('--sizes', type=lambda s: [tuple(int(v) for v in size.split('x')) for size in s.split(',')], default=[(80, 24), (200, 60), (400, 120)])
+  parser.add_argument('--runs', type=int, default=5)
+  parser.add_argument('--images', type=int, default=8)
+  parser.add_argument('--image-size', type=lambda s: tuple(int(v) for v in s.split('x')), default=(6000, 4000))
+  parser.add_argument('--think', type=float, default=0.5)
+  args = parser.parse_args()
+  BENCHMARKS[args.benchmark](args)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,54 @@
+"""
+Decoding of images to the cell grid of the terminal. Kept out of __main__,
+the functions run in worker processes must be importable by their module
+name, which __main__ is not under python -m.
+"""
+
+from dataclasses import dataclass
+from typing import Tuple
+import PIL.Image
+
+TERMINAL_ASPECT_RATIO = 1/2
+
+# images are resized in two steps: an integer reduction to at least this many times the
+# final size, which decoders or a box filter do cheaply, then a bicubic resampling
+REDUCING_GAP = 3.0
+
+@dataclass
+class Image:
+  # original is decoded at a reduced size when possible, size is the size of the file
+  original: PIL.Image
+  size: Tuple[int, int]
+  resized: PIL.Image
+
+def open_image(path, hint_resize):
+  img = PIL.Image.open(path)
+  size = img.size
+  (width, height) = cell_grid(size, hint_resize)
+  # every cell shows two pixels stacked
+  grid_size = (width, height * 2)
+  # jpegs are decoded at 1/2, 1/4 or 1/8 of their size if that is still larger than the grid,
+  # without decoding the full image first. Other formats are fully decoded
+  img.draft('RGB', (int(grid_size[0] * REDUCING_GAP), int(grid_size[1] * REDUCING_GAP)))
+  return Image(img, size, resize_frame(img, grid_size))
+
+def resize_frame(img, grid_size):
+  if img.mode not in ('RGB', 'RGBA', 'L'):
+    img = img.convert('RGB')
+  return img.resize(grid_size, PIL.Image.Resampling.BICUBIC, reducing_gap=REDUCING_GAP).convert('RGB')
+
+def cell_grid(image_size, fit_size):
+  # the number of terminal cells the image is printed on
+  (fit_width, fit_height) = fit_size
+  (img_width, img_height) = image_size
+  r = min(fit_width / img_width * TERMINAL_ASPECT_RATIO, fit_height / img_height)
+  return (max(1, int(img_width / TERMINAL_ASPECT_RATIO * r)), max(1, int(img_height * r)))
+
+def make_thumbnail(path, fit_size):
+  # the thumbnail grid of an image as (size, rgb bytes), empty if it cannot be read so that
+  # other files in a folder of images are cached too. Runs in worker processes
+  try:
+    grid = open_image(path, fit_size).resized
+  except OSError:
+    return ((0, 0), b"")
+  return (grid.size, grid.tobytes())
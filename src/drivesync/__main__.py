@@ -1,16 +1,42 @@
+import collections
+import functools
 import itertools
 import pathlib
 import logging
 import json
+import os
 import shutil
 import sys
-from . import difftool
-from .googledrive import GDrive, GDriveFile
+import time
+from . import difftool, packs, stateformat
+from .googledrive import GDrive, GDriveFile, DEFAULT_UPLOAD_CHUNK_SIZE
+from .ratelimit import DEFAULT_REQUESTS_PER_SECOND, MAX_REQUESTS_PER_SECOND, backoff_delay, is_not_found
 from .common import Common
+from .hashcache import HashCache
+from .remotecache import RemoteCache
+from .remotestate import RemoteState, segment_sequence
+from .stats import stats
+from .storage import BATCH_MAX_REQUESTS
+from .transfer import TransferScheduler
+from .uploadjournal import UploadJournal
+from .watcher import DirtyPaths, Watcher
 
 DRIVESYNC_FILE_NAME = 'drivesync.json'
-STATE_FILE_NAME = 'drivestate.txt'
+STATE_FILE_NAME = 'drivestate.bin'
+LEGACY_STATE_FILE_NAME = 'drivestate.txt'
+HASH_CACHE_FILE_NAME = 'drivestate.cache'
+UPLOAD_JOURNAL_FILE_NAME = 'drivestate.uploads'
+DIRTY_PATHS_FILE_NAME = 'drivestate.dirty'
+TOKEN_FILE_NAME = 'drivestate.token'
+REMOTE_CACHE_FILE_NAME = 'drivestate.remote'
+# temporary files of atomic writes and downloads, see Common.atomic_file
+TEMP_FILES_PATTERN = Common.SIBLING_TEMP_PREFIX + '*'
+WATCH_DEBOUNCE_SECONDS = 2
+WATCH_MAX_DELAY_SECONDS = 30
 DRY_ATTEMPT = False
+JOBS = 1
+PRINT_STATS = False
+STATS_JSON_FILE = None
 
 """
 Usage:
@@ -29,12 +55,24 @@ class DriveSync:
     local_path = None
     settings_file = None
     gdrive = None
-    exluded_files = [STATE_FILE_NAME]
-    gdrive_root = None
+    exluded_files = [STATE_FILE_NAME, LEGACY_STATE_FILE_NAME, HASH_CACHE_FILE_NAME, UPLOAD_JOURNAL_FILE_NAME,
+                     DIRTY_PATHS_FILE_NAME, DIRTY_PATHS_FILE_NAME + '.lock', TOKEN_FILE_NAME, REMOTE_CACHE_FILE_NAME,
+                     TEMP_FILES_PATTERN, packs.PACKS_DIRECTORY]
+    settings = None
+    _gdrive_root = None
+    hash_cache = None
+    remote_cache = None
+    pack_threshold = 0
+    pack_size = packs.DEFAULT_PACK_SIZE
+    repack_dead_ratio = packs.DEFAULT_REPACK_DEAD_RATIO
+    hash_algorithm = difftool.DEFAULT_HASH_ALGORITHM
 
-    def __init__(self, local_path):
+    def __init__(self, local_path, backend=None):
+        # the backend defaults to the google drive of the credentials of the settings
         self.local_path = local_path
+        self.gdrive = backend
         self.settings_file = pathlib.Path(local_path, DRIVESYNC_FILE_NAME)
+        self.dirty_paths = DirtyPaths(pathlib.Path(local_path, DIRTY_PATHS_FILE_NAME))
         
     def init(self):
         if not self.settings_file.is_file():
@@ -45,52 +83,144 @@ class DriveSync:
             self.exluded_files += [str(l) for l in settings['excluded']]
         if 'sync-name' not in settings:
             raise Exception("sync-name not in drivesync.txt")
+        self.pack_threshold = settings.get('pack-threshold', self.pack_threshold)
+        self.pack_size = settings.get('pack-size', self.pack_size)
+        self.repack_dead_ratio = settings.get('repack-dead-ratio', self.repack_dead_ratio)
+        self.hash_algorithm = settings.get('hash-algorithm', self.hash_algorithm)
+        if self.hash_algorithm not in difftool.HASH_ALGORITHMS:
+            raise Exception(f"Unknown hash-algorithm {self.hash_algorithm}, expected one of {list(difftool.HASH_ALGORITHMS)}")
 
-        self.gdrive = GDrive(pathlib.Path(self.local_path, settings['credentials']))
-        
+        self.settings = settings
+
+        # nothing is loaded nor requested until the remote is used
+        if self.gdrive is None:
+            self.gdrive = GDrive(pathlib.Path(self.local_path, settings['credentials']),
+                                 settings.get('upload-chunk-size', DEFAULT_UPLOAD_CHUNK_SIZE),
+                                 settings.get('requests-per-second', DEFAULT_REQUESTS_PER_SECOND),
+                                 pathlib.Path(self.local_path, TOKEN_FILE_NAME),
+                                 settings.get('max-requests-per-second', MAX_REQUESTS_PER_SECOND))
+        self.gdrive.upload_journal = UploadJournal(pathlib.Path(self.local_path, UPLOAD_JOURNAL_FILE_NAME))
+
+    @property
+    def gdrive_root(self):
+        # found, or created, on first use: local only commands like dry pushes never connect
+        if self._gdrive_root is None:
+            with stats.phase('connect'):
+                self._gdrive_root = self.connect()
+        return self._gdrive_root
+
+    @gdrive_root.setter
+    def gdrive_root(self, gdrive_root):
+        self._gdrive_root = gdrive_root
+
+    def connect(self):
         remote_root = GDriveFile.get_root(self.gdrive)
-        sync_root_name = settings['sync-name']
+        sync_root_name = self.settings['sync-name']
         sync_root = remote_root.get_child(sync_root_name)
         if sync_root is None:
             print(f"Creating root directory {sync_root_name}")
-            self.gdrive_root = remote_root.mkdir(sync_root_name)
-            shared_users = settings["shared"]
+            sync_root = remote_root.mkdir(sync_root_name)
+            shared_users = self.settings["shared"]
             if shared_users is not None:
-                for usr in shared_users:
-                    self.gdrive.grant_user_permissions(self.gdrive_root.id, usr)
+                with self.gdrive.batch() as batch:
+                    for usr in shared_users:
+                        batch.add(usr, self.gdrive.grant_user_permissions_request(sync_root.id, usr))
+                if batch.errors:
+                    raise Exception(f"Could not share {sync_root_name} with {list(batch.errors)}")
+        elif not sync_root.is_directory:
+            raise Exception(f"sync root '{sync_root_name}' is not a directory")
+        return sync_root
+
+    def index_remote(self):
+        # indexes the remote tree from the remote cache, brought up to date with the changes
+        # made since it was written. Without a cache, or if it cannot be updated, the tree is listed
+        if self.remote_cache is None:
+            self.remote_cache = RemoteCache(pathlib.Path(self.local_path, REMOTE_CACHE_FILE_NAME), self.settings['sync-name'])
+            self.remote_cache.load()
+        cache = self.remote_cache
+        if cache.root_id is not None and self.update_remote_cache():
+            self.gdrive_root = cache.build_tree(self.gdrive)
         else:
-            if not sync_root.is_directory:
-                raise Exception(f"sync root '{sync_root_name}' is not a directory")
-            self.gdrive_root = sync_root
-        
+            if cache.root_id is not None:
+                # the sync root may be gone, it is looked up again
+                self.gdrive_root = None
+            cache.rebuild(self.gdrive, self.gdrive_root)
+        cache.save()
 
-    def fetch_remote_state(self):
-        remote_state_file = self.gdrive_root.get_child(STATE_FILE_NAME)
-        if remote_state_file is None:
-            return []
-        remote_state_file_local_copy = remote_state_file.download()
-        return difftool.parse_state(remote_state_file_local_copy.read_text())
+    def update_remote_cache(self):
+        try:
+            return self.remote_cache.update(self.gdrive)
+        except Exception as e:
+            print(f"Could not update the remote cache: {e}")
+            return False
 
-    def load_local_states(self):
+    def get_remote_state(self):
+        return RemoteState(self.gdrive_root, [STATE_FILE_NAME, LEGACY_STATE_FILE_NAME], self.hash_algorithm)
+
+    def get_indexed_state(self):
+        # the remote state and its sequence as the indexed tree has them, None if the sync does not
+        # hash with md5, the only hash drive knows, or if some files are in packs, which only the
+        # state files list. Files without md5 are google documents, which have no content to download
+        if self.hash_algorithm != 'md5':
+            return None
+        state = []
+        sequence = 0
+        for (path, f) in self.gdrive_root.index.items():
+            if path.startswith(f"{packs.PACKS_DIRECTORY}/"):
+                return None
+            if f.parent is self.gdrive_root and segment_sequence(f.name) is not None:
+                sequence = max(sequence, segment_sequence(f.name))
+            elif f.is_directory or f.md5 is not None:
+                state.append(difftool.StateFile(path, f.is_directory, f.md5))
+        return (state, sequence)
+
+    def load_local_states(self, dirty_paths=None, hash_new_files=True):
+        # without hash_new_files the files that were not in the last state are not hashed,
+        # pushes hash them while uploading them
         local_state_file = pathlib.Path(self.local_path, STATE_FILE_NAME)
+        legacy_state_file = pathlib.Path(self.local_path, LEGACY_STATE_FILE_NAME)
         last_sync_state = []
-        if local_state_file.is_file():
-            last_sync_state = difftool.parse_state(local_state_file.read_text())
-            last_sync_state = difftool.remove_ignored(last_sync_state, self.exluded_files)
+        last_sync_sequence = None
+        with stats.phase('read_state'):
+            for state_file in [local_state_file, legacy_state_file]:
+                if state_file.is_file():
+                    (last_sync_state, metadata) = stateformat.read_state(state_file)
+                    # states written before the algorithm was recorded have md5 hashes
+                    if metadata.get('hash-algorithm', 'md5') != self.hash_algorithm:
+                        raise Exception(f"{state_file.name} is hashed with {metadata.get('hash-algorithm', 'md5')}, "
+                                        f"the hash-algorithm of a sync cannot be changed once it was synced")
+                    last_sync_state = difftool.remove_ignored(last_sync_state, self.exluded_files)
+                    last_sync_sequence = metadata.get('sequence')
+                    break
         
-        current_state = difftool.read_local_files(self.local_path)
-        current_state = difftool.remove_ignored(current_state, self.exluded_files)
+        # hashing is done while scanning, its own time is in the hashing_seconds counter
+        with stats.phase('scan'):
+            self.hash_cache = hash_cache = HashCache(pathlib.Path(self.local_path, HASH_CACHE_FILE_NAME), self.hash_algorithm)
+            # uploads only compute md5 hashes, with another algorithm new files are hashed here
+            known_paths = None if hash_new_files or self.hash_algorithm != 'md5' else {f.path for f in last_sync_state}
+            if dirty_paths is None:
+                current_state = difftool.read_local_files(self.local_path, hash_cache, JOBS, self.exluded_files, known_paths, self.hash_algorithm)
+            else:
+                print(f"Rescanning {len(dirty_paths)} changed paths")
+                current_state = difftool.rescan_paths(self.local_path, last_sync_state, dirty_paths, hash_cache, JOBS, self.exluded_files, known_paths, self.hash_algorithm)
+            hash_cache.save()
+            print(f"Hashed {hash_cache.misses} files, {hash_cache.hits} unchanged")
+            current_state = difftool.remove_ignored(current_state, self.exluded_files)
         
-        return (local_state_file, last_sync_state, current_state)
+        return (local_state_file, last_sync_state, last_sync_sequence, current_state)
 
     def sync_push(self):
-        (local_state_file, last_sync_state, current_state) = self.load_local_states()
+        # only the paths changed since the last sync are read if a watcher tracked them
+        (dirty_paths, taken) = self.dirty_paths.take()
+        (local_state_file, last_sync_state, last_sync_sequence, current_state) = self.load_local_states(dirty_paths, hash_new_files=False)
         
         applied_diff = difftool.diff_states(last_sync_state, current_state)
         (new, removed, changed) = applied_diff
 
         if len(new) == 0 and len(removed) == 0 and len(changed) == 0:
             print("No diff")
+            if not DRY_ATTEMPT:
+                self.dirty_paths.consumed(taken)
             return
 
         removed.sort(reverse=True)
@@ -99,56 +229,199 @@ class DriveSync:
         if DRY_ATTEMPT:
             return print(f"{new=}\n{removed=}\n{changed=}")
 
-        # remove old files
-        for f in removed:
-            (parent, file) = self.gdrive_root.get_deep(f.path)
-            if file is not None:
-                print(f"Removing remote {f.path}")
-                file.remove()
-            else:
-                print(f"Removing remote {f.path} - already absent")
+        with stats.phase('remote_index'):
+            self.index_remote()
+        scheduler = TransferScheduler(JOBS)
 
-        # upload new files and create new directories
-        for f in new:
-            (parent, file) = self.gdrive_root.get_deep(f.path, mkdir_if_missing=True)
-            file_name = pathlib.Path(f.path).name
-            local_file = pathlib.Path(self.local_path, f.path)
-            if f.is_directory:
-                print(f"Creating remote {f.path}/")
-                parent.mkdir(file_name)
-            else:
-                print(f"Uploading remote {f.path}")
-                parent.upload_file(file_name, local_file)
+        # small files are uploaded in packs, packed files have no remote file of their own
+        with stats.phase('pack'):
+            (built_packs, repacked, packed) = self.pack_small_files(last_sync_state, current_state, applied_diff)
+        last_sync_map = {f.path: f for f in last_sync_state}
+        remote_removed = [f for f in removed if f.pack is None]
+        remote_removed += [last_sync_map[f.path] for f in packed if f.path in last_sync_map and last_sync_map[f.path].pack is None]
+        packed_paths = {f.path for f in packed}
+
+        # remove old files, deepest first, and create new directories, shallowest first
+        # each stage is split in batches that run concurrently
+        for (depth, files) in group_by_depth(remote_removed):
+            for batch in chunks(files, BATCH_MAX_REQUESTS):
+                scheduler.add((0, -depth), f"Removing {len(batch)} remote entries", functools.partial(self.remove_remote_batch, batch))
+        for (depth, files) in group_by_depth(f for f in new if f.is_directory):
+            for batch in chunks(files, BATCH_MAX_REQUESTS):
+                scheduler.add((1, depth), f"Creating {len(batch)} remote directories", functools.partial(self.mkdir_remote_batch, batch))
+
+        # upload new and changed files, then delete the packs that were repacked
+        for f in itertools.chain(new, changed):
+            if not f.is_directory and f.path not in packed_paths and f.pack is None:
+                scheduler.add((2,), f"Uploading remote {f.path}", functools.partial(self.upload_remote, f))
+        for (pack_file, pack_name, members) in built_packs:
+            scheduler.add((2,), f"Uploading pack {pack_name} ({len(members)} files)", functools.partial(self.upload_pack, pack_file, pack_name))
+        for batch in chunks(sorted(repacked), BATCH_MAX_REQUESTS):
+            scheduler.add((3,), f"Removing {len(batch)} repacked packs", functools.partial(self.remove_packs_batch, batch))
+
+        with stats.phase('transfers'):
+            scheduler.run()
+        # new files were hashed while being uploaded
+        self.hash_cache.save()
 
-        # upload changed files
-        for f in changed:
-            # assuming no file became a directory
-            (parent, file) = self.gdrive_root.get_deep(f.path, mkdir_if_missing=True)
-            file_name = pathlib.Path(f.path).name
-            print(f"Uploading remote {f.path}")
-            parent.upload_file(file_name, f.path)
+        # update remote state, only the diff is uploaded
+        with stats.phase('remote_state'):
+            remote_state = self.get_remote_state()
+            (remote_sequence, _, remote_deltas) = remote_state.list_segments()
+            remote_sequence = max([remote_sequence or 0, *remote_deltas])
+            sequence = remote_state.append(applied_diff)
+        # if other deltas were pushed since the last pull they must still be pulled
+        if (last_sync_sequence or 0) < remote_sequence:
+            sequence = last_sync_sequence
 
         # update the remote state locally
-        local_state_file.write_text(difftool.serialize_state(current_state))
-
-        # update remote state
-        remote_state = self.fetch_remote_state()
-        remote_state = difftool.merge_diff(remote_state, applied_diff)
-        remote_state_file_local_copy = Common.get_temp_file('txt')
-        remote_state_file_local_copy.write_text(difftool.serialize_state(remote_state))
-        self.gdrive_root.upload_file(STATE_FILE_NAME, remote_state_file_local_copy)
+        with stats.phase('write_state'):
+            self.write_local_state(local_state_file, current_state, sequence)
+        self.dirty_paths.consumed(taken)
         print('Ending sync')
 
+    def pack_small_files(self, last_sync_state, current_state, applied_diff):
+        # packs the new and changed files smaller than pack_threshold, and the live members
+        # of the packs that have too many dead members. The packs of the files are updated,
+        # files moved to another pack are added to the changed files.
+        # Returns the built packs, the packs to delete and the packed files
+        (new, removed, changed) = applied_diff
+        packs.carry_packs(current_state, last_sync_state)
+        live = packs.live_members(current_state)
+        repacked = set(packs.packs_to_repack(packs.live_members(last_sync_state), live, self.repack_dead_ratio))
+        if self.pack_threshold <= 0 and not repacked:
+            return ([], repacked, [])
+
+        packed = [f for f in itertools.chain(new, changed)
+                  if not f.is_directory and os.path.getsize(pathlib.Path(self.local_path, f.path)) < self.pack_threshold]
+        # contents already stored in a pack that is kept are not packed again
+        pack_of = {file_hash: pack for (pack, hashes) in live.items() if pack not in repacked for file_hash in hashes}
+
+        builder = packs.PackBuilder(self.pack_size)
+        for f in packed:
+            local_file = pathlib.Path(self.local_path, f.path)
+            content = None
+            if f.file_hash is None:
+                stat = local_file.stat()
+                content = local_file.read_bytes()
+                f.file_hash = difftool.hash_bytes(content, self.hash_algorithm)
+                self.hash_cache.add(f.path, local_file, stat, f.file_hash)
+            if f.file_hash not in pack_of:
+                builder.add(f.file_hash, local_file.read_bytes() if content is None else content)
+        for pack in repacked:
+            hashes = live.get(pack, set()) - pack_of.keys()
+            if hashes:
+                print(f"Repacking {len(hashes)} files of {pack}")
+                (_, pack_file) = self.gdrive_root.get_deep(f"{packs.PACKS_DIRECTORY}/{pack}")
+                for (file_hash, content) in packs.read_members(pack_file.download(), hashes).items():
+                    builder.add(file_hash, content)
+        built_packs = builder.flush()
+
+        for (pack_file, pack_name, members) in built_packs:
+            pack_of.update((file_hash, pack_name) for file_hash in members)
+        for f in packed:
+            f.pack = pack_of[f.file_hash]
+        diff_paths = {f.path for f in itertools.chain(new, changed)}
+        for f in current_state:
+            if f.pack in repacked:
+                f.pack = pack_of[f.file_hash]
+                if f.path not in diff_paths:
+                    changed.append(f)
+        return (built_packs, repacked, packed)
+
+    def upload_pack(self, pack_file, pack_name):
+        packs_directory = self.gdrive_root.mkdir(packs.PACKS_DIRECTORY)
+        packs_directory.upload_file(pack_name, pack_file)
+        return pack_file.stat().st_size
+
+    def remove_packs_batch(self, pack_names):
+        packs_directory = self.gdrive_root.get_child(packs.PACKS_DIRECTORY)
+        with self.gdrive.batch() as batch:
+            for pack_name in pack_names:
+                pack_file = None if packs_directory is None else packs_directory.get_child(pack_name)
+                if pack_file is not None:
+                    pack_file.remove(batch)
+
+    def unpack_local(self, pack_name, files, local_hashes):
+        files = [f for f in files if local_hashes.get(f.path) != f.file_hash]
+        if not files:
+            return 0
+        (_, pack_file) = self.gdrive_root.get_deep(f"{packs.PACKS_DIRECTORY}/{pack_name}")
+        if pack_file is None:
+            raise Exception(f"Pack {pack_name} does not exist on remote")
+        local_pack = pack_file.download()
+        members = packs.read_members(local_pack, {f.file_hash for f in files})
+        for f in files:
+            content = members[f.file_hash]
+            if difftool.hash_bytes(content, self.hash_algorithm) != f.file_hash:
+                raise Exception(f"Checksum mismatch unpacking {f.path} from {pack_name}")
+            local_path = pathlib.Path(self.local_path, f.path)
+            local_path.parent.mkdir(parents=True, exist_ok=True)
+            if local_path.is_dir():
+                shutil.rmtree(str(local_path))
+            Common.atomic_write(local_path, content)
+            self.hash_cache.add(f.path, local_path, local_path.stat(), f.file_hash)
+        return local_pack.stat().st_size
+
+    def watch(self):
+        watcher = Watcher(self.local_path, self.exluded_files)
+        self.dirty_paths.start(os.getpid())
+        try:
+            # the dirty set is not complete yet, the first push scans everything
+            self.sync_push()
+            (first_event, last_event) = (None, None)
+            (deadline, retry_at, failures) = (None, float('-inf'), 0)
+            print("Watching for changes")
+            while True:
+                timeout = None if deadline is None else max(0, deadline - time.monotonic())
+                (paths, overflow) = watcher.read_events(timeout)
+                if paths or overflow:
+                    if overflow:
+                        print("Events were lost, the next push will rescan everything")
+                    self.dirty_paths.add(paths, overflow)
+                    last_event = time.monotonic()
+                    first_event = first_event or last_event
+                    # at most WATCH_MAX_DELAY_SECONDS after the first change even during a long copy,
+                    # and not before the retry of a failed push
+                    deadline = max(retry_at, min(last_event + WATCH_DEBOUNCE_SECONDS, first_event + WATCH_MAX_DELAY_SECONDS))
+                if deadline is None or time.monotonic() < deadline:
+                    continue
+                (first_event, last_event, deadline) = (None, None, None)
+                try:
+                    self.sync_push()
+                    (retry_at, failures) = (float('-inf'), 0)
+                except Exception as e:
+                    # the dirty paths were not consumed, the push is retried even if nothing changes
+                    delay = max(WATCH_DEBOUNCE_SECONDS, backoff_delay(failures))
+                    failures += 1
+                    print(f"Push failed: {e}, retrying in {delay:.1f}s")
+                    retry_at = deadline = time.monotonic() + delay
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.dirty_paths.stop()
+            watcher.close()
+
     def sync_pull(self):
-        remote_state = self.fetch_remote_state()
+        (local_state_file, last_sync_state, last_sync_sequence, current_state) = self.load_local_states()
+        with stats.phase('remote_index'):
+            self.index_remote()
+        # the remote tree tells what changed, the state files are only read when files are in packs
+        with stats.phase('remote_state'):
+            indexed_state = self.get_indexed_state()
+            if indexed_state is None:
+                (remote_state, remote_sequence) = self.get_remote_state().fetch(last_sync_state, last_sync_sequence)
+            else:
+                (remote_state, remote_sequence) = indexed_state
         remote_state = difftool.remove_ignored(remote_state, self.exluded_files)
-        (local_state_file, last_sync_state, current_state) = self.load_local_states()
         
         applied_diff = difftool.diff_states(last_sync_state, remote_state)
         (new, removed, changed) = applied_diff
 
         if len(new) == 0 and len(removed) == 0 and len(changed) == 0:
             print("No diff")
+            if remote_sequence != last_sync_sequence and not DRY_ATTEMPT:
+                self.write_local_state(local_state_file, last_sync_state, remote_sequence)
             return
         
         removed.sort(reverse=True)
@@ -157,34 +430,118 @@ class DriveSync:
         if DRY_ATTEMPT:
             return print(f"{new=}\n{removed=}\n{changed=}")
 
-        # remove old files
+        scheduler = TransferScheduler(JOBS)
+
+        # remove old files, deepest first
         for f in removed:
-            print(f"Removing local {f.path}")
-            fpath = pathlib.Path(self.local_path, f.path)
-            if fpath.is_dir():
-                shutil.rmtree(str(fpath))
-            else:
-                fpath.unlink()
+            scheduler.add((0, -path_depth(f.path)), f"Removing local {f.path}", functools.partial(self.remove_local, f))
 
-        # download new and updated files
+        # create new directories, then download new and updated files
+        local_hashes = {f.path: f.file_hash for f in current_state}
+        packed_files = collections.defaultdict(list)
         for f in itertools.chain(new, changed):
-            (parent, file) = self.gdrive_root.get_deep(f.path)
-            local_path = pathlib.Path(self.local_path, f.path)
-            if file is None:
-                print(f"Tried to download {f.path} but file does not exist on remote")
+            if f.is_directory:
+                scheduler.add((1,), f"Creating local {f.path}/", functools.partial(self.mkdir_local, f))
+            elif f.pack is not None:
+                packed_files[f.pack].append(f)
             else:
-                print(f"Downloading local {f.path}")
-                local_path.parent.mkdir(parents=True, exist_ok=True)
-                if local_path.exists():
-                    local_path.unlink()
-                if file.is_directory:
-                    local_path.mkdir()
-                else:
-                    file.download().rename(local_path)
+                scheduler.add((2,), f"Downloading local {f.path}", functools.partial(self.download_local, f, local_hashes.get(f.path)))
+        for (pack_name, files) in packed_files.items():
+            scheduler.add((2,), f"Unpacking {len(files)} files from {pack_name}", functools.partial(self.unpack_local, pack_name, files, local_hashes))
+
+        with stats.phase('transfers'):
+            scheduler.run()
+        # downloaded files were hashed as they arrived
+        self.hash_cache.save()
 
         # update local state
-        current_state = difftool.merge_diff(current_state, applied_diff)
-        local_state_file.write_text(difftool.serialize_state(current_state))
+        with stats.phase('write_state'):
+            current_state = difftool.merge_diff(current_state, applied_diff)
+            packs.carry_packs(current_state, remote_state)
+            self.write_local_state(local_state_file, current_state, remote_sequence)
+
+    def write_local_state(self, local_state_file, state, sequence):
+        stateformat.write_state(local_state_file, state, { 'sequence': sequence, 'hash-algorithm': self.hash_algorithm })
+        # the legacy text state is replaced by the binary state once written
+        pathlib.Path(self.local_path, LEGACY_STATE_FILE_NAME).unlink(missing_ok=True)
+
+    def remove_remote_batch(self, files):
+        removed = {}
+        with self.gdrive.batch() as batch:
+            for f in files:
+                (parent, file) = self.gdrive_root.get_deep(f.path)
+                if file is None:
+                    print(f"Removing remote {f.path} - already absent")
+                else:
+                    removed[file.get_path()] = file
+                    file.remove(batch)
+        # the delta of the push records these files as removed, it must not be appended if they are not
+        for (path, error) in batch.errors.items():
+            if is_not_found(error):
+                print(f"Removing remote {path} - already absent")
+                removed[path].forget()
+        errors = [path for (path, error) in batch.errors.items() if not is_not_found(error)]
+        if errors:
+            raise Exception(f"Could not remove remote entries {errors}")
+
+    def mkdir_remote_batch(self, files):
+        with self.gdrive.batch() as batch:
+            for f in files:
+                (parent, file) = self.gdrive_root.get_deep(f.path, mkdir_if_missing=True)
+                parent.mkdir(pathlib.Path(f.path).name, batch)
+        if batch.errors:
+            raise Exception(f"Could not create remote directories {list(batch.errors)}")
+
+    def upload_remote(self, f):
+        (parent, file) = self.gdrive_root.get_deep(f.path, mkdir_if_missing=True)
+        local_file = pathlib.Path(self.local_path, f.path)
+        stat = local_file.stat()
+        md5_hashes = self.hash_algorithm == 'md5'
+        (uploaded, md5) = parent.upload_file(local_file.name, local_file, f.file_hash if md5_hashes else None)
+        if md5 is None:
+            raise Exception(f"Could not upload {f.path}")
+        if md5_hashes:
+            if f.file_hash is None:
+                self.hash_cache.add(f.path, local_file, stat, md5)
+            # the remote now has the content that was read, even if the file changed since the scan
+            f.file_hash = md5
+        if not uploaded:
+            print(f"Skipping upload of {f.path} - already on remote")
+            return 0
+        return stat.st_size
+
+    def remove_local(self, f):
+        fpath = pathlib.Path(self.local_path, f.path)
+        if fpath.is_dir():
+            shutil.rmtree(str(fpath))
+        elif fpath.exists():
+            fpath.unlink()
+
+    def mkdir_local(self, f):
+        pathlib.Path(self.local_path, f.path).mkdir(parents=True, exist_ok=True)
+
+    def download_local(self, f, local_hash=None):
+        (parent, file) = self.gdrive_root.get_deep(f.path)
+        local_path = pathlib.Path(self.local_path, f.path)
+        if file is None:
+            print(f"Tried to download {f.path} but file does not exist on remote")
+            return 0
+        md5_hashes = self.hash_algorithm == 'md5'
+        if local_hash is not None and local_hash == (file.md5 if md5_hashes else f.file_hash):
+            print(f"Skipping download of {f.path} - already up to date")
+            return 0
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        if local_path.is_dir():
+            shutil.rmtree(str(local_path))
+        # written next to local_path and renamed, once its content was checked
+        if md5_hashes:
+            file_hash = file.download_to(local_path, f.file_hash or file.md5)
+        else:
+            # drive only knows the md5, the hash of the sync is computed as the content arrives
+            file_hash = file.download_to(local_path, file.md5, difftool.new_hasher(self.hash_algorithm), f.file_hash)
+        stat = local_path.stat()
+        self.hash_cache.add(f.path, local_path, stat, file_hash)
+        return stat.st_size
 
     def full_wipe(self):
         if input("Do a full wipe? (yes)") == 'yes':
@@ -193,13 +550,35 @@ class DriveSync:
                 self.gdrive.delete_files(f['id'])
 
 
+def path_depth(path):
+    return len(pathlib.PurePath(path).parts)
+
+def group_by_depth(files):
+    files = sorted(files, key=lambda f: path_depth(f.path))
+    return [(depth, list(group)) for (depth, group) in itertools.groupby(files, key=lambda f: path_depth(f.path))]
+
+def chunks(items, size):
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+def get_option(names, default=None):
+    for name in names:
+        if name in sys.argv:
+            i = sys.argv.index(name)
+            if i+1 < len(sys.argv):
+                return sys.argv[i+1]
+    return default
+
 def main():
-    global DRY_ATTEMPT
+    global DRY_ATTEMPT, JOBS, PRINT_STATS, STATS_JSON_FILE
     
     mode = '' if len(sys.argv) < 2 else sys.argv[1]
     DRY_ATTEMPT = '--dry' in sys.argv
-    if mode not in ['init', 'pull', 'push', 'wipe']:
-        print('Usage: <init|pull|push|wipe>')
+    jobs = get_option(['-j', '--jobs'], '1')
+    JOBS = max(1, int(jobs)) if jobs.isdigit() else None
+    PRINT_STATS = '--stats' in sys.argv
+    STATS_JSON_FILE = get_option(['--stats-json'])
+    if mode not in ['init', 'pull', 'push', 'watch', 'wipe'] or JOBS is None:
+        print('Usage: <init|pull|push|watch|wipe> [--dry] [-j <jobs>] [--stats] [--stats-json <file>]')
         return
         
     sync = DriveSync('.')
@@ -212,13 +591,22 @@ def main():
             print(f"Initialized a drivesync directory, fill in {DRIVESYNC_FILE_NAME} and run with push")
         return
 
-    sync.init()
+    try:
+        sync.init()
 
-    Common.setup()
-    if mode == 'pull':
-        sync.sync_pull()
-    elif mode == 'push':
-        sync.sync_push()
-    elif mode == 'wipe':
-        sync.full_wipe()
-    Common.teardown()
+        Common.setup()
+        if mode == 'pull':
+            sync.sync_pull()
+        elif mode == 'push':
+            sync.sync_push()
+        elif mode == 'watch':
+            sync.watch()
+        elif mode == 'wipe':
+            sync.full_wipe()
+        Common.teardown()
+    finally:
+        # also reported when the sync failed, to see how far it went
+        if PRINT_STATS:
+            print(stats.report())
+        if STATS_JSON_FILE is not None:
+            stats.write_json(STATS_JSON_FILE)
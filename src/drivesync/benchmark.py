@@ -0,0 +1,240 @@
+"""
+Benchmarks for drivesync, run on synthetic trees created in a temporary directory.
+
+Usage:
+python -m drivesync.benchmark hashing [--files N] [--size BYTES] [--jobs 1,2,4,8]
+python -m drivesync.benchmark algorithms [--sizes 4096,1048576,...] [--total BYTES]
+python -m drivesync.benchmark exclusions [--paths N] [--legacy-paths N]
+python -m drivesync.benchmark sync [--trees small,huge,deep] [--sync-jobs N] [--latency S] [--quota N] [--bandwidth BYTES]
+python -m drivesync.benchmark startup [--runs N] [--files N]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import mmap
+import os
+import pathlib
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from . import __main__ as drivesync_main
+from . import difftool
+from .common import Common
+from .localbackend import LocalBackend
+
+def make_tree(root, file_count, file_size, files_per_dir=100):
+    root = pathlib.Path(root)
+    for i in range(file_count):
+        directory = root.joinpath(f"d{i // files_per_dir}")
+        directory.mkdir(exist_ok=True)
+        directory.joinpath(f"f{i}.bin").write_bytes(os.urandom(file_size))
+    return root
+
+def bench_hashing(args):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        root = make_tree(temp_dir, args.files, args.size)
+        total_mb = args.files * args.size / 1e6
+        print(f"{args.files} files of {args.size} bytes, {total_mb:.1f}MB (page cache is warm after the first run)")
+        difftool.read_local_files(root)
+        baseline = None
+        for jobs in args.jobs:
+            start = time.perf_counter()
+            difftool.read_local_files(root, jobs=jobs)
+            elapsed = time.perf_counter() - start
+            baseline = elapsed if baseline is None else baseline
+            print(f"  jobs={jobs:<3} {elapsed:8.3f}s {total_mb/elapsed:9.1f}MB/s  x{baseline/elapsed:.2f}")
+
+def legacy_hash_file(path, algorithm):
+    # hash_file before reads into a reused buffer, a new bytes object per chunk
+    hasher = difftool.new_hasher(algorithm)
+    with open(path, 'rb') as f:
+        while data := f.read(65536):
+            hasher.update(data)
+    return hasher.hexdigest()
+
+def mmap_hash_file(path, algorithm):
+    hasher = difftool.new_hasher(algorithm)
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                hasher.update(mapped)
+    return hasher.hexdigest()
+
+HASH_READERS = {
+    'read': legacy_hash_file,
+    'readinto': difftool.hash_file,
+    'mmap': mmap_hash_file,
+}
+
+def bench_algorithms(args):
+    # hashes a file of each size until args.total bytes were hashed, from the page cache
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = pathlib.Path(temp_dir, 'file.bin')
+        print(f"{'size':>10} {'algorithm':<9} " + ' '.join(f"{reader:>10}" for reader in HASH_READERS) + "  (MB/s)")
+        for size in args.sizes:
+            path.write_bytes(os.urandom(size))
+            runs = max(1, args.total // size)
+            for algorithm in difftool.HASH_ALGORITHMS:
+                speeds = []
+                for reader in HASH_READERS.values():
+                    reader(path, algorithm)
+                    start = time.perf_counter()
+                    for _ in range(runs):
+                        reader(path, algorithm)
+                    speeds.append(size * runs / (time.perf_counter() - start) / 1e6)
+                print(f"{size:>10} {algorithm:<9} " + ' '.join(f"{speed:10.0f}" for speed in speeds))
+
+EXCLUSION_PATTERNS = ['*.log', 'node_modules', 'build', '.git', '*.tmp', 'cache/*', 'src/gen/*.c', '[._]*.sw?']
+EXCLUSION_NAMES = ['main.c', 'app.log', 'node_modules', 'build', 'readme.md', 'x.tmp', '.main.swp', 'cache', 'gen', 'src']
+
+def make_paths(count, seed=0):
+    rng = random.Random(seed)
+    paths = set()
+    while len(paths) < count:
+        depth = rng.randint(1, 6)
+        parts = [rng.choice(EXCLUSION_NAMES) + ('' if rng.random() < 0.7 else str(rng.randint(0, 99))) for _ in range(depth)]
+        # every parent of a path is also in the state, like in a real tree
+        paths.update(os.sep.join(parts[:i]) for i in range(1, depth+1))
+    return [difftool.StateFile(path, not path.endswith(('.c', '.md', '.log', '.tmp'))) for path in paths]
+
+def legacy_remove_ignored(state, excluded):
+    # remove_ignored before precompiled exclusions, used as the reference
+    state.sort()
+    excluded_paths = []
+    included_files = []
+    for f in state:
+        pure_path = pathlib.PurePath(f.path)
+        parent_path = str(pathlib.Path(f.path).parent)
+        if parent_path in excluded_paths or any(pure_path.match(ex) for ex in excluded):
+            excluded_paths.append(f.path)
+        else:
+            included_files.append(f)
+    return included_files
+
+def bench_exclusions(args):
+    for (name, count, remove_ignored) in [('legacy', args.legacy_paths, legacy_remove_ignored),
+                                          ('compiled', args.legacy_paths, difftool.remove_ignored),
+                                          ('compiled', args.paths, difftool.remove_ignored)]:
+        state = make_paths(count)
+        start = time.perf_counter()
+        included = remove_ignored(state, EXCLUSION_PATTERNS)
+        elapsed = time.perf_counter() - start
+        print(f"  {name:<9} {len(state):>8} paths {elapsed:8.3f}s {len(state)/elapsed:12.0f} paths/s, {len(state)-len(included)} excluded")
+
+    state = make_paths(args.legacy_paths, seed=1)
+    expected = [f.path for f in legacy_remove_ignored(list(state), EXCLUSION_PATTERNS)]
+    actual = [f.path for f in difftool.remove_ignored(list(state), EXCLUSION_PATTERNS)]
+    print(f"  results identical to legacy: {expected == actual}")
+
+def make_deep_tree(root, depth, branches):
+    # branches chains of depth nested directories, with a small file in each directory
+    root = pathlib.Path(root)
+    for branch in range(branches):
+        directory = root.joinpath(f"b{branch}")
+        for level in range(depth):
+            directory = directory.joinpath(f"l{level}")
+            directory.mkdir(parents=True)
+            directory.joinpath('f.txt').write_bytes(os.urandom(256))
+    return root
+
+SYNC_TREES = {
+    'small': lambda root, args: make_tree(root, args.small_files, 4 * 1024, files_per_dir=50),
+    'huge': lambda root, args: make_tree(root, args.huge_files, args.huge_size),
+    'deep': lambda root, args: make_deep_tree(root, args.depth, args.branches),
+}
+
+def run_sync(local_path, backend, action):
+    pathlib.Path(local_path, drivesync_main.DRIVESYNC_FILE_NAME).write_text(json.dumps({ 'sync-name': 'benchmark', 'shared': [] }))
+    sync = drivesync_main.DriveSync(local_path, backend)
+    (calls, uploaded, downloaded) = (sum(backend.calls.values()), backend.bytes_uploaded, backend.bytes_downloaded)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        sync.init()
+        getattr(sync, action)()
+    elapsed = time.perf_counter() - start
+    return (elapsed, sum(backend.calls.values()) - calls, backend.bytes_uploaded - uploaded, backend.bytes_downloaded - downloaded)
+
+def bench_sync(args):
+    # pushes a synthetic tree to a local backend, then pulls it in an empty directory
+    drivesync_main.JOBS = args.sync_jobs
+    print(f"jobs={args.sync_jobs} latency={args.latency}s quota={args.quota or '-'}req/s bandwidth={args.bandwidth or '-'}B/s")
+    Common.setup()
+    try:
+        for tree in args.trees:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                (source, destination) = (pathlib.Path(temp_dir, 'source'), pathlib.Path(temp_dir, 'destination'))
+                source.mkdir()
+                destination.mkdir()
+                SYNC_TREES[tree](source, args)
+                backend = LocalBackend(pathlib.Path(temp_dir, 'remote'), args.latency, args.quota, args.bandwidth)
+                # the second pull has nothing to do, it only fetches the remote changes
+                for (name, action, local_path) in [('push', 'sync_push', source), ('pull', 'sync_pull', destination), ('pull2', 'sync_pull', destination)]:
+                    (elapsed, calls, uploaded, downloaded) = run_sync(local_path, backend, action)
+                    print(f"  {tree:<6} {name:<5} {elapsed:8.2f}s {calls:7} calls {uploaded/1e6:9.1f}MB up {downloaded/1e6:9.1f}MB down")
+    finally:
+        Common.teardown()
+
+def time_command(code, cwd, runs):
+    # runs code in fresh interpreters, returns the best and median wall times
+    env = dict(os.environ, PYTHONPATH=str(pathlib.Path(__file__).resolve().parent.parent))
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=cwd, env=env, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return (min(times), statistics.median(times))
+
+def bench_startup(args):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        make_tree(temp_dir, args.files, 1024)
+        pathlib.Path(temp_dir, 'drivesync.json').write_text(json.dumps({ 'sync-name': 'benchmark', 'credentials': 'missing.json', 'shared': [] }))
+        commands = [
+            ('python', 'pass'),
+            ('import drivesync', 'import drivesync.__main__'),
+            ('import google libraries', 'import googleapiclient.discovery, googleapiclient.http, google.oauth2.service_account'),
+            ('build drive service', 'from googleapiclient.discovery import build; build("drive", "v3", developerKey="-")'),
+            (f"push --dry ({args.files} files)", 'import sys; from drivesync.__main__ import main; sys.argv = ["drivesync", "push", "--dry"]; main()'),
+        ]
+        for (name, code) in commands:
+            (best, median) = time_command(code, temp_dir, args.runs)
+            print(f"  {name:<28} best {best*1000:8.1f}ms  median {median*1000:8.1f}ms")
+
+BENCHMARKS = {
+    'hashing': bench_hashing,
+    'algorithms': bench_algorithms,
+    'exclusions': bench_exclusions,
+    'sync': bench_sync,
+    'startup': bench_startup,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="drivesync benchmarks")
+    parser.add_argument('benchmark', choices=BENCHMARKS.keys())
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=256*1024)
+    parser.add_argument('--jobs', type=lambda s: [int(j) for j in s.split(',')], default=[1, 2, 4, 8])
+    parser.add_argument('--sizes', type=lambda s: [int(size) for size in s.split(',')], default=[4096, 256*1024, 4*1024*1024, 64*1024*1024])
+    parser.add_argument('--total', type=int, default=256*1024*1024)
+    parser.add_argument('--paths', type=int, default=1_000_000)
+    parser.add_argument('--legacy-paths', type=int, default=20_000)
+    parser.add_argument('--trees', type=lambda s: s.split(','), default=list(SYNC_TREES))
+    parser.add_argument('--sync-jobs', type=int, default=8)
+    parser.add_argument('--small-files', type=int, default=1000)
+    parser.add_argument('--huge-files', type=int, default=4)
+    parser.add_argument('--huge-size', type=int, default=64*1024*1024)
+    parser.add_argument('--depth', type=int, default=50)
+    parser.add_argument('--branches', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--quota', type=float, default=None)
+    parser.add_argument('--bandwidth', type=float, default=None)
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+if __name__ == '__main__':
+    main()
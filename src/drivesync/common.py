@@ -1,9 +1,13 @@
+import contextlib
+import os
 import random
 import string
 import tempfile
 import pathlib
 
 class Common:
+    SIBLING_TEMP_PREFIX = '.drivestate.'
+
     @staticmethod
     def setup():
         Common.temp_dir = tempfile.TemporaryDirectory()
@@ -16,4 +20,25 @@ class Common:
     def get_temp_file(extension=None):
         name = ''.join(random.choices(string.ascii_uppercase + string.digits, k=10))
         return pathlib.Path(Common.temp_dir.name, f"{name}.{extension}" if extension is not None else name)
-    
\ No newline at end of file
+    
+    @staticmethod
+    @contextlib.contextmanager
+    def atomic_file(path):
+        # yields a binary file written next to path, which replaces path once closed
+        # without error. Its name starts with SIBLING_TEMP_PREFIX, which syncs exclude
+        path = pathlib.Path(path)
+        (fd, temp_path) = tempfile.mkstemp(prefix=f"{Common.SIBLING_TEMP_PREFIX}{path.name}.", suffix='.tmp', dir=path.parent)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                yield f
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    @staticmethod
+    def atomic_write(path, content):
+        with Common.atomic_file(path) as f:
+            f.write(content if isinstance(content, bytes) else content.encode())
@@ -1,15 +1,34 @@
-import pathlib
+import collections
+import functools
+import os
 import hashlib
 import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .exclusions import ExclusionMatcher, parent_path
+from .stats import stats
 
 TYPE_DIRECTORY = 'D'
 TYPE_FILE = 'F'
 
+# algorithms the files of a sync may be hashed with, recorded in its states.
+# md5 is the one drive computes, other algorithms cost a second hash of transferred files
+HASH_ALGORITHMS = {
+    'md5': hashlib.md5,
+    'sha256': hashlib.sha256,
+    'blake2b': lambda: hashlib.blake2b(digest_size=32),
+}
+DEFAULT_HASH_ALGORITHM = 'md5'
+HASH_BUFFER_SIZE = 1024 * 1024
+
 class StateFile:
-    def __init__(self, path, is_directory, file_hash=None):
+    def __init__(self, path, is_directory, file_hash=None, pack=None):
         self.path = path
         self.is_directory = is_directory
         self.file_hash = file_hash
+        # name of the remote pack storing the file, see packs.py
+        self.pack = pack
 
     def __str__(self) -> str:
         return f"{TYPE_DIRECTORY if self.is_directory else TYPE_FILE},{self.path},{self.file_hash}"
@@ -27,25 +46,131 @@ class StateFile:
             return StateFile(parts[1], False, parts[2])
 
 
-def read_local_files(path):
-    all_files = list(pathlib.Path(path).rglob('*'))
-    state = []
-    for f in all_files:
-        if f.is_dir():
-            state.append(StateFile(str(f.relative_to(path)), True))
-        elif f.is_file():
-            state.append(StateFile(str(f.relative_to(path)), False, hash_file(f)))
-    return state
-
-def hash_file(path):
-    md5 = hashlib.md5()
-    with open(path, 'rb') as f:
+def read_local_files(path, hash_cache=None, jobs=1, excluded=None, known_paths=None, algorithm=DEFAULT_HASH_ALGORITHM):
+    return list(iter_local_files(path, hash_cache, jobs, excluded, known_paths, algorithm))
+
+def iter_local_files(path, hash_cache=None, jobs=1, excluded=None, known_paths=None, algorithm=DEFAULT_HASH_ALGORITHM):
+    # streams the state of the local files, hashing them as they are walked.
+    # When known_paths is given, files that are not in it are new whatever their content
+    # and are not hashed unless their hash is cached: they get no hash, to be computed
+    # while they are uploaded. The hash cache hashes with its own algorithm
+    return ordered_parallel_map(functools.partial(read_file_state, hash_cache, known_paths, algorithm), walk_local_files(path, excluded), jobs)
+
+def read_file_state(hash_cache, known_paths, algorithm, entry):
+    (rel_path, file_path, is_directory) = entry
+    if is_directory:
+        return StateFile(rel_path, True)
+    if known_paths is not None and rel_path not in known_paths:
+        return StateFile(rel_path, False, None if hash_cache is None else hash_cache.get_cached_hash(rel_path, file_path))
+    file_hash = hash_file(file_path, algorithm) if hash_cache is None else hash_cache.get_hash(rel_path, file_path)
+    return StateFile(rel_path, False, file_hash)
+
+def rescan_paths(path, state, dirty_paths, hash_cache=None, jobs=1, excluded=None, known_paths=None, algorithm=DEFAULT_HASH_ALGORITHM):
+    # returns the state with the dirty paths, and everything under them, read again from disk
+    dirty_roots = set()
+    for dirty_path in sorted(dirty_paths, key=lambda p: p.count(os.sep)):
+        if not is_under(dirty_path, dirty_roots):
+            dirty_roots.add(dirty_path)
+    kept_state = [f for f in state if not is_under(f.path, dirty_roots)]
+    if hash_cache is not None:
+        hash_cache.keep(f.path for f in kept_state)
+
+    matcher = None if not excluded else ExclusionMatcher.compile(tuple(excluded))
+    def walk_dirty_roots():
+        for dirty_root in dirty_roots:
+            full_path = os.path.join(path, dirty_root)
+            if matcher is not None and matcher.matches(dirty_root):
+                continue
+            if os.path.isdir(full_path):
+                yield (dirty_root, full_path, True)
+                if not os.path.islink(full_path):
+                    yield from walk_local_files(path, excluded, dirty_root)
+            elif os.path.isfile(full_path):
+                yield (dirty_root, full_path, False)
+
+    return kept_state + list(ordered_parallel_map(functools.partial(read_file_state, hash_cache, known_paths, algorithm), walk_dirty_roots(), jobs))
+
+def is_under(path, roots):
+    # whether path or one of its parents is in roots
+    while path not in roots:
+        parent = os.path.dirname(path)
+        if parent == path or parent == '':
+            return False
+        path = parent
+    return True
+
+def walk_local_files(path, excluded=None, rel_root=''):
+    # yields (relative path, path, is directory) for every file and directory under path/rel_root,
+    # excluded entries are skipped and excluded directories are not walked at all.
+    # Like Path.rglob, symlinks to directories are listed but not followed
+    matcher = None if not excluded else ExclusionMatcher.compile(tuple(excluded))
+    directories = [(rel_root, os.path.join(path, rel_root))]
+    while directories:
+        (rel_dir, dir_path) = directories.pop()
+        with os.scandir(dir_path) as entries:
+            sub_directories = []
+            for entry in entries:
+                rel_path = entry.name if rel_dir == '' else os.path.join(rel_dir, entry.name)
+                if matcher is not None and matcher.matches(rel_path):
+                    continue
+                if entry.is_dir():
+                    yield (rel_path, entry.path, True)
+                    if not entry.is_symlink():
+                        sub_directories.append((rel_path, entry.path))
+                elif entry.is_file():
+                    yield (rel_path, entry.path, False)
+            directories.extend(reversed(sub_directories))
+
+def ordered_parallel_map(function, items, jobs, max_pending=None):
+    # like map(), results are yielded in the order of items, but up to 'jobs'
+    # items are processed at once, hashlib and file reads release the GIL.
+    # At most 'max_pending' results are kept in memory
+    if jobs <= 1:
+        yield from map(function, items)
+        return
+    max_pending = jobs * 4 if max_pending is None else max_pending
+    with ThreadPoolExecutor(jobs) as pool:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.submit(function, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def new_hasher(algorithm=DEFAULT_HASH_ALGORITHM):
+    if algorithm not in HASH_ALGORITHMS:
+        raise Exception(f"Unknown hash algorithm {algorithm}, expected one of {list(HASH_ALGORITHMS)}")
+    return HASH_ALGORITHMS[algorithm]()
+
+def hash_bytes(content, algorithm=DEFAULT_HASH_ALGORITHM):
+    hasher = new_hasher(algorithm)
+    hasher.update(content)
+    return hasher.hexdigest()
+
+# a read buffer per hashing thread, reused for every file it hashes
+hash_buffers = threading.local()
+
+def hash_file(path, algorithm=DEFAULT_HASH_ALGORITHM):
+    # reads into a reused buffer, without a new bytes object per chunk. mmap is a bit faster
+    # on large files but a file truncated while it is mapped kills the process with SIGBUS
+    start = time.perf_counter()
+    hasher = new_hasher(algorithm)
+    if not hasattr(hash_buffers, 'view'):
+        hash_buffers.view = memoryview(bytearray(HASH_BUFFER_SIZE))
+    view = hash_buffers.view
+    size = 0
+    with open(path, 'rb', buffering=0) as f:
         while True:
-            data = f.read(65536)
-            if not data:
+            length = f.readinto(view)
+            if not length:
                 break
-            md5.update(data)
-    return md5.hexdigest()
+            hasher.update(view[:length])
+            size += length
+    stats.add('hashed_files', 1)
+    stats.add('hashed_bytes', size)
+    stats.add('hashing_seconds', time.perf_counter() - start)
+    return hasher.hexdigest()
 
 def parse_state(state_content):
     return [StateFile.parse(line) for line in state_content.splitlines()]
@@ -75,15 +200,16 @@ def diff_states(state_from, state_to):
     return diff
 
 def remove_ignored(state, excluded, excluded_paths=None):
+    matcher = excluded if isinstance(excluded, ExclusionMatcher) else ExclusionMatcher.compile(tuple(excluded))
     state.sort()
-    excluded_paths = [] if excluded_paths is None else excluded_paths
+    excluded_set = set() if excluded_paths is None else set(excluded_paths)
     included_files = []
 
     for f in state:
-        pure_path = pathlib.PurePath(f.path)
-        parent_path = str(pathlib.Path(f.path).parent)
-        if parent_path in excluded_paths or any(pure_path.match(ex) for ex in excluded):
-            excluded_paths.append(f.path)
+        if parent_path(f.path) in excluded_set or matcher.matches(f.path):
+            excluded_set.add(f.path)
+            if excluded_paths is not None:
+                excluded_paths.append(f.path)
         else:
             included_files.append(f)
 
@@ -93,7 +219,7 @@ def merge_diff(state, applied_diff):
     (new, removed, changed) = applied_diff
     new_state_map = {f.path: f for f in state}
     for f in removed:
-        del new_state_map[f.path]
+        new_state_map.pop(f.path, None)
     for changed in itertools.chain(new, changed):
         new_state_map[changed.path] = changed
     return list(new_state_map.values())
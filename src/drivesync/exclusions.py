@@ -0,0 +1,60 @@
+import fnmatch
+import functools
+import os
+import pathlib
+import re
+
+# matches what pathlib.PurePath.match does for the platform's flavour
+CASE_INSENSITIVE = os.name == 'nt'
+SEPARATORS = re.compile(r'[\\/]' if os.name == 'nt' else '/')
+
+def split_path(path):
+    return [part for part in SEPARATORS.split(path) if part and part != '.']
+
+def parent_path(path):
+    # same as str(pathlib.Path(path).parent) for the relative, normalized paths of states
+    parts = SEPARATORS.split(path)
+    return os.sep.join(parts[:-1]) if len(parts) > 1 else '.'
+
+class ExclusionMatcher:
+    """
+    Precompiled set of exclusion patterns, matches paths like
+    any(pathlib.PurePath(path).match(pattern) for pattern in patterns) would:
+    a pattern matches the last components of the path, one glob per component.
+    Single component patterns, the most common, are merged in a single regex
+    that is run on the file name only.
+    """
+
+    def __init__(self, patterns):
+        single_part = []
+        self.multi_part = []
+        for pattern in patterns:
+            pure_pattern = pathlib.PurePath(pattern.lower() if CASE_INSENSITIVE else pattern)
+            if not pure_pattern.parts:
+                raise ValueError("empty pattern")
+            if pure_pattern.anchor:
+                # absolute patterns never match the relative paths of states
+                continue
+            if len(pure_pattern.parts) == 1:
+                single_part.append(fnmatch.translate(pure_pattern.parts[0]))
+            else:
+                self.multi_part.append([re.compile(fnmatch.translate(part)) for part in reversed(pure_pattern.parts)])
+        self.single_part = re.compile('|'.join(single_part)) if single_part else None
+
+    @staticmethod
+    @functools.lru_cache(maxsize=16)
+    def compile(patterns):
+        return ExclusionMatcher(patterns)
+
+    def matches(self, path):
+        if CASE_INSENSITIVE:
+            path = path.lower()
+        parts = split_path(path)
+        if not parts:
+            return False
+        if self.single_part is not None and self.single_part.match(parts[-1]):
+            return True
+        for part_patterns in self.multi_part:
+            if len(part_patterns) <= len(parts) and all(p.match(part) for (p, part) in zip(part_patterns, reversed(parts))):
+                return True
+        return False
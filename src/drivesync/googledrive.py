@@ -1,110 +1,358 @@
-import io
+import datetime
+import json
+import mimetypes
+import os
+import posixpath
 import pathlib
+import threading
 from typing import Self, Tuple
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload
 from .common import Common
+from .difftool import hash_file
+from .ratelimit import AdaptiveRateLimiter, RequestExecutor, DEFAULT_REQUESTS_PER_SECOND, MAX_REQUESTS_PER_SECOND
+from .stats import stats
+from .storage import StorageBackend
+from .streams import HashingReader, HashingWriter
 
 MIMETYPE_FOLDER = 'application/vnd.google-apps.folder'
+# number of folders listed by a single files.list query when indexing a tree,
+# bounded by the maximum length of the query
+INDEX_FOLDERS_PER_QUERY = 50
+# resumable uploads are sent in chunks, which must be multiples of 256KiB
+UPLOAD_CHUNK_GRANULARITY = 256 * 1024
+DEFAULT_UPLOAD_CHUNK_SIZE = 32 * UPLOAD_CHUNK_GRANULARITY
+DISCOVERY_URI = 'https://www.googleapis.com/discovery/v1/apis/drive/v3/rest'
+DISCOVERY_CACHE_FILE = pathlib.Path(os.environ.get('XDG_CACHE_HOME', '~/.cache'), 'drivesync', 'drive.v3.json')
+# a cached access token is only reused if it is valid for at least that long
+TOKEN_MIN_VALIDITY = datetime.timedelta(minutes=5)
+
+class GDrive(StorageBackend):
+    """
+    The google libraries are only imported, the credentials loaded and the
+    services built when the first request is made, so that commands that do not
+    reach drive start fast.
+    """
 
-class GDrive:
     SCOPES = ['https://www.googleapis.com/auth/drive']
+    # the discovery document, read once per process
+    discovery_document = None
+    discovery_lock = threading.Lock()
+
+    def __init__(self, service_account_file, upload_chunk_size=DEFAULT_UPLOAD_CHUNK_SIZE, requests_per_second=DEFAULT_REQUESTS_PER_SECOND, token_file=None,
+                 max_requests_per_second=MAX_REQUESTS_PER_SECOND):
+        # token_file keeps the access token between runs, to not request a new one every time
+        self.service_account_file = service_account_file
+        self.token_file = None if token_file is None else pathlib.Path(token_file)
+        self.lock = threading.Lock()
+        self._credentials = None
+        self.thread_local = threading.local()
+        self.upload_chunk_size = max(1, round(upload_chunk_size / UPLOAD_CHUNK_GRANULARITY)) * UPLOAD_CHUNK_GRANULARITY
+        self.upload_journal = None
+        # shared by all the threads, so that they are throttled together
+        self._executor = RequestExecutor(AdaptiveRateLimiter(requests_per_second, max_rate=max_requests_per_second))
+
+    @property
+    def executor(self):
+        return self._executor
+
+    @property
+    def credentials(self):
+        # shared by all the threads, refreshed once here rather than by the first request of each of them
+        with self.lock:
+            if self._credentials is None:
+                from google.oauth2 import service_account
+                credentials = service_account.Credentials.from_service_account_file(self.service_account_file, scopes=GDrive.SCOPES)
+                self.load_token(credentials)
+                if not credentials.valid:
+                    import google_auth_httplib2
+                    import httplib2
+                    credentials.refresh(google_auth_httplib2.Request(httplib2.Http()))
+                    self.save_token(credentials)
+                self._credentials = credentials
+            return self._credentials
+
+    def load_token(self, credentials):
+        if self.token_file is None or not self.token_file.is_file():
+            return
+        try:
+            token = json.loads(self.token_file.read_text())
+            if token['account'] != credentials.service_account_email or token['scopes'] != GDrive.SCOPES:
+                return
+            expiry = datetime.datetime.fromisoformat(token['expiry'])
+        except (OSError, ValueError, KeyError):
+            return
+        # google-auth works with naive utc datetimes
+        if expiry - TOKEN_MIN_VALIDITY > datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None):
+            (credentials.token, credentials.expiry) = (token['token'], expiry)
+
+    def save_token(self, credentials):
+        if self.token_file is None or credentials.expiry is None:
+            return
+        token = { 'account': credentials.service_account_email, 'scopes': GDrive.SCOPES,
+                  'token': credentials.token, 'expiry': credentials.expiry.isoformat() }
+        # written through a temporary file only readable by its owner, like the credentials should be
+        Common.atomic_write(self.token_file, json.dumps(token))
+
+    @staticmethod
+    def get_discovery_document():
+        # googleapiclient ships the documents of its apis, versions that do not had to fetch
+        # them at every build, the fetched document is then cached on disk
+        with GDrive.discovery_lock:
+            if GDrive.discovery_document is None:
+                document = None
+                try:
+                    from googleapiclient import discovery_cache
+                    document = discovery_cache.get_static_doc('drive', 'v3')
+                except (ImportError, AttributeError):
+                    pass
+                cache_file = DISCOVERY_CACHE_FILE.expanduser()
+                if document is None and cache_file.is_file():
+                    document = cache_file.read_text()
+                if document is None:
+                    import httplib2
+                    (response, content) = httplib2.Http().request(DISCOVERY_URI)
+                    if response.status != 200:
+                        raise Exception(f"Could not fetch the drive discovery document: {response.status}")
+                    document = content.decode()
+                    cache_file.parent.mkdir(parents=True, exist_ok=True)
+                    Common.atomic_write(cache_file, document)
+                GDrive.discovery_document = document
+            return GDrive.discovery_document
+
+    @property
+    def drive_service(self):
+        # the underlying httplib2 connection is not thread safe, each thread gets its own service.
+        # Services modify the parsed document as they are used, each one parses its own copy
+        if not hasattr(self.thread_local, 'drive_service'):
+            from googleapiclient.discovery import build_from_document
+            self.thread_local.drive_service = build_from_document(GDrive.get_discovery_document(), credentials=self.credentials)
+        return self.thread_local.drive_service
+
+    def execute(self, request, description=None):
+        return self.executor.execute(request, description)
 
-    def __init__(self, service_account_file):
-        credentials = service_account.Credentials.from_service_account_file(service_account_file, scopes=GDrive.SCOPES)
-        self.drive_service = build('drive', 'v3', credentials=credentials)
+    def execute_batch(self, requests):
+        responses = {}
+        def callback(request_id, response, exception):
+            responses[request_id] = (response, exception)
+        batch = self.drive_service.new_batch_http_request(callback=callback)
+        for (i, request) in enumerate(requests):
+            batch.add(request, request_id=str(i))
+        batch.execute()
+        return [responses.get(str(i), (None, Exception("no response"))) for i in range(len(requests))]
 
-    def create_folder(self, folder_name, parent_folder_id=None):
+    def create_folder_request(self, folder_name, parent_folder_id=None):
         folder_metadata = {
             'name': folder_name,
             'mimeType': "application/vnd.google-apps.folder",
             'parents': [parent_folder_id] if parent_folder_id else []
         }
+        return self.drive_service.files().create(body=folder_metadata, fields='id')
 
-        created_folder = self.drive_service.files().create(body=folder_metadata, fields='id').execute()
-        folder_id = created_folder["id"]
-        return folder_id
-    
-    def grant_user_permissions(self, file_id, user_email):
+    def grant_user_permissions_request(self, file_id, user_email):
         permission = { 'type': 'user', 'role': 'writer', 'emailAddress': user_email }
-        self.drive_service.permissions().create(fileId=file_id, body=permission, sendNotificationEmail=False).execute()
+        return self.drive_service.permissions().create(fileId=file_id, body=permission, sendNotificationEmail=False)
 
     def list_folder(self, parent_folder_id=None):
-        results = self.drive_service.files().list(
-            q=f"'{parent_folder_id}' in parents and trashed=false" if parent_folder_id else None,
-            pageSize=1000,
-            fields="nextPageToken, files(id, name, mimeType)"
-        ).execute()
-        items = results.get('files', [])
-        return [] if not items else items
-
-    def delete_files(self, file_or_folder_id):
-        try:
-            self.drive_service.files().delete(fileId=file_or_folder_id).execute()
-        except Exception as e:
-            print(f"Error deleting file/folder with ID: {file_or_folder_id}: {str(e)}")
+        query = f"'{parent_folder_id}' in parents and trashed=false" if parent_folder_id else None
+        return list(self.list_files(query, "id, name, mimeType, md5Checksum, modifiedTime"))
+
+    def list_folders(self, parent_folder_ids):
+        # lists the direct children of many folders at once, files are returned with their 'parents'
+        parents_query = ' or '.join(f"'{folder_id}' in parents" for folder_id in parent_folder_ids)
+        return self.list_files(f"({parents_query}) and trashed=false", "id, name, mimeType, md5Checksum, modifiedTime, parents")
+
+    def list_files(self, query, file_fields):
+        page_token = None
+        while True:
+            results = self.execute(self.drive_service.files().list(
+                q=query,
+                pageSize=1000,
+                pageToken=page_token,
+                fields=f"nextPageToken, files({file_fields})"
+            ), "Listing files")
+            yield from results.get('files', [])
+            page_token = results.get('nextPageToken')
+            if page_token is None:
+                return
+
+    def delete_files_request(self, file_or_folder_id):
+        return self.drive_service.files().delete(fileId=file_or_folder_id)
+
+    def get_changes_token(self):
+        return self.execute(self.drive_service.changes().getStartPageToken(), "Getting the changes token")['startPageToken']
+
+    def list_changes(self, page_token):
+        changes = []
+        while True:
+            results = self.execute(self.drive_service.changes().list(
+                pageToken=page_token,
+                pageSize=1000,
+                spaces='drive',
+                includeRemoved=True,
+                fields="nextPageToken, newStartPageToken, changes(fileId, removed, file(id, name, mimeType, md5Checksum, modifiedTime, parents, trashed))"
+            ), "Listing changes")
+            changes += results.get('changes', [])
+            if 'newStartPageToken' in results:
+                return (changes, results['newStartPageToken'])
+            page_token = results['nextPageToken']
 
-    def download_file(self, file_id, destination_path):
+    def download_file(self, file_id, destination):
+        from googleapiclient.http import MediaIoBaseDownload
         request = self.drive_service.files().get_media(fileId=file_id)
-        fh = io.FileIO(destination_path, mode='wb')
-        downloader = MediaIoBaseDownload(fh, request)
-        
+        downloader = MediaIoBaseDownload(destination, request)
+
         done = False
         while not done:
-            status, done = downloader.next_chunk()
+            # the downloader only moves forward once a chunk was received, a failed chunk is asked again
+            status, done = self.executor.run(downloader.next_chunk, f"Downloading {file_id}", method=request.methodId)
 
     def upload_file(self, folder_id, file_name, local_file_path):
+        from googleapiclient.errors import HttpError
         try:
-            file_metadata = { "name": file_name, "parents": [folder_id] }
-            media = MediaFileUpload(local_file_path)
-            file = self.drive_service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields="id"
-            ).execute()
-            return file["id"]
+            with open(local_file_path, 'rb') as f:
+                (reader, media) = self.hashing_media(f, local_file_path)
+                file_metadata = { "name": file_name, "parents": [folder_id] }
+                request = self.drive_service.files().create(
+                    body=file_metadata,
+                    media_body=media,
+                    fields="id, md5Checksum"
+                )
+                file = self.execute_upload(request, f"{folder_id}/{file_name}", local_file_path)
+                return (file["id"], GDrive.verified_md5(reader, file, local_file_path))
         except HttpError as error:
             print(f"An error occurred while uploading {file_name}: {error}")
-            return None
+            return (None, None)
+
+    def hashing_media(self, f, local_file_path):
+        from googleapiclient.http import MediaIoBaseUpload
+        # the file is hashed as its chunks are sent, instead of being read once more
+        reader = HashingReader(f)
+        mimetype = mimetypes.guess_type(str(local_file_path))[0] or 'application/octet-stream'
+        return (reader, MediaIoBaseUpload(reader, mimetype, chunksize=self.upload_chunk_size, resumable=True))
+
+    @staticmethod
+    def verified_md5(reader, file, local_file_path):
+        md5 = reader.hexdigest()
+        if file.get("md5Checksum", md5) != md5:
+            raise Exception(f"Checksum mismatch after uploading {local_file_path}, it may have changed during the upload")
+        return md5
     
+    def execute_upload(self, request, upload_key, local_file_path):
+        # sends a resumable upload chunk by chunk, recording its progress in the upload journal
+        from googleapiclient.errors import HttpError
+        journal = self.upload_journal
+        session = None if journal is None else journal.get_session(upload_key, local_file_path)
+        if session is not None:
+            print(f"Resuming upload of {local_file_path} from byte {session['offset']}")
+            request.resumable_uri = session['uri']
+            request.resumable_progress = session['offset']
+        # the offset of a resumed or failed upload is asked to the server before the next chunk,
+        # the journal or the failed chunk may not match what it actually received
+        resync = session is not None
+
+        def send_chunk():
+            nonlocal resync
+            if resync:
+                file = GDrive.query_upload(request)
+                resync = False
+                if file is not None:
+                    return (None, file)
+            return request.next_chunk()
+
+        def on_retry():
+            nonlocal resync
+            resync = request.resumable_uri is not None
+
+        response = None
+        while response is None:
+            try:
+                (status, response) = self.executor.run(send_chunk, f"Uploading {local_file_path}", on_retry=on_retry, method=request.methodId)
+            except HttpError as error:
+                if session is None or error.resp.status not in (404, 410):
+                    raise
+                print(f"Upload session of {local_file_path} expired, restarting")
+                session = None
+                resync = False
+                request.resumable_uri = None
+                request.resumable_progress = 0
+                continue
+            if response is None and journal is not None:
+                journal.record(upload_key, local_file_path, request.resumable_uri, request.resumable_progress)
+
+        if journal is not None:
+            journal.finish(upload_key)
+        return response
+
+    @staticmethod
+    def query_upload(request):
+        # asks the server how many bytes of the upload session it received, with an empty PUT,
+        # and moves the upload to that offset. Returns the uploaded file if it was complete
+        from googleapiclient.errors import HttpError
+        headers = { 'Content-Range': f"bytes */{request.resumable.size()}", 'Content-Length': '0' }
+        (response, content) = request.http.request(request.resumable_uri, 'PUT', headers=headers)
+        if response.status in (200, 201):
+            return request.postproc(response, content)
+        if response.status != 308:
+            raise HttpError(response, content, uri=request.resumable_uri)
+        # 'bytes=0-<last byte received>', absent when nothing was received
+        received = response.get('range')
+        request.resumable_progress = int(received.rsplit('-', 1)[1]) + 1 if received else 0
+        return None
+
     def upload_existing_file(self, file_id, local_file_path):
+        from googleapiclient.errors import HttpError
         try:
-            media = MediaFileUpload(local_file_path)
-            # createMethod.<locals>.method() takes 1 positional argument but 2 were given ???
-            self.drive_service.files().update(
-                file_id,
-                media_body=media,
-                fields="id"
-            ).execute()
+            with open(local_file_path, 'rb') as f:
+                (reader, media) = self.hashing_media(f, local_file_path)
+                request = self.drive_service.files().update(
+                    fileId=file_id,
+                    media_body=media,
+                    fields="id, md5Checksum"
+                )
+                file = self.execute_upload(request, file_id, local_file_path)
+                return GDrive.verified_md5(reader, file, local_file_path)
         except HttpError as error:
             print(f"An error occurred while uploading {file_id}: {error}")
+            return None
 
 class GDriveFile:
-    def __init__(self, gdrive, name, id, parent, is_directory=True):
+    def __init__(self, gdrive, name, id, parent, is_directory=True, md5=None, modified_time=None):
         self.gdrive = gdrive
         self.name = name
         self.id = id
         self.parent = parent
         self.is_directory = is_directory
+        self.md5 = md5
+        self.modified_time = modified_time
         self.children = None
+        self.lock = threading.RLock()
+        # path -> file of every indexed descendant, shared by the whole indexed tree
+        self.index = None
+        self.index_key = None
+        if parent is not None and parent.index is not None:
+            self.index = parent.index
+            self.index_key = name if parent.index_key == '' else f"{parent.index_key}/{name}"
 
     @staticmethod
     def get_root(gdrive):
         return GDriveFile(gdrive, None, None, None, True)
 
     def get_path(self):
-        return "/" if not self.parent else f"{self.parent.get_path()}{self.name}{"" if not self.is_directory else "/"}"
+        return "/" if not self.parent else f"{self.parent.get_path()}{self.name}{'' if not self.is_directory else '/'}"
 
     def get_child(self, child_name):
-        self.explore_self()
-        for f in self.children:
-            if f.name == child_name:
-                return f
-        return None
+        with self.lock:
+            self.explore_self()
+            return self.children.get(child_name)
     
     def get_deep(self, path, mkdir_if_missing=False) -> Tuple[Self, Self]:
+        if self.index_key == '':
+            key = pathlib.PurePath(path).as_posix()
+            parent_key = posixpath.dirname(key)
+            parent = self if parent_key == '' else self.index.get(parent_key)
+            if parent is not None and parent.is_directory:
+                return (parent, self.index.get(key))
+
         parent, file = None, self
         parts = pathlib.Path(path).parts
         for part in parts[:-1]:
@@ -118,48 +366,158 @@ class GDriveFile:
         return (parent, file)
     
     def get_children(self):
-        self.explore_self()
-        return self.children
+        with self.lock:
+            self.explore_self()
+            return list(self.children.values())
     
-    def mkdir(self, child_name):
-        child = self.get_child(child_name)
-        if child is None:
-            folder_id = self.gdrive.create_folder(child_name, self.id)
-            child = GDriveFile(self.gdrive, child_name, folder_id, self, True)
-            self.children.append(child)
+    def mkdir(self, child_name, batch=None):
+        # when batched the directory is only created when the batch is flushed, None is returned
+        with self.lock:
+            child = self.get_child(child_name)
+            if child is None:
+                if batch is not None:
+                    request = self.gdrive.create_folder_request(child_name, self.id)
+                    batch.add(f"{self.get_path()}{child_name}/", request,
+                              lambda response: self.add_child(child_name, response['id'], True, is_empty=True))
+                    return None
+                folder_id = self.gdrive.create_folder(child_name, self.id)
+                child = self.add_child(child_name, folder_id, True, is_empty=True)
         if not child.is_directory:
             raise Exception(child.get_path() + " is not a directory")
         return child
-    
+
+    def add_child(self, name, id, is_directory, is_empty=False, md5=None, modified_time=None):
+        child = GDriveFile(self.gdrive, name, id, self, is_directory, md5, modified_time)
+        if is_directory and (is_empty or self.index is not None):
+            # the children of indexed directories are filled by index_tree
+            child.children = {}
+        with self.lock:
+            # drive allows duplicate names, the first listed file wins
+            child = self.children.setdefault(name, child)
+        if child.index is not None:
+            child.index.setdefault(child.index_key, child)
+        return child
+
     def explore_self(self):
-        if self.children is not None:
-            return
-        if not self.is_directory:
-            raise Exception(f"{self.get_path()} is not a directory")
-        self.children = [
-            GDriveFile(self.gdrive, f['name'], f['id'], self, f['mimeType'] == MIMETYPE_FOLDER)
-            for f in self.gdrive.list_folder(self.id)
-        ]
-        print(f"Explored {self.get_path()}, got {[f.name for f in self.children]}")
-
-    def remove(self):
-        self.gdrive.delete_files(self.id)
+        with self.lock:
+            if self.children is not None:
+                return
+            if not self.is_directory:
+                raise Exception(f"{self.get_path()} is not a directory")
+            self.children = {}
+            for f in self.gdrive.list_folder(self.id):
+                self.add_child(f['name'], f['id'], f['mimeType'] == MIMETYPE_FOLDER, md5=f.get('md5Checksum'), modified_time=f.get('modifiedTime'))
+        print(f"Explored {self.get_path()}, got {list(self.children)}")
+
+    def index_tree(self):
+        # lists every descendant level by level, listing many folders per query
+        # instead of one query per folder, and indexes them by path
+        self.reset_index()
+        level = [self]
+        while level:
+            next_level = []
+            for i in range(0, len(level), INDEX_FOLDERS_PER_QUERY):
+                folders = {folder.id: folder for folder in level[i:i+INDEX_FOLDERS_PER_QUERY]}
+                for f in self.gdrive.list_folders(folders.keys()):
+                    parent = next(folders[p] for p in f['parents'] if p in folders)
+                    child = parent.add_child(f['name'], f['id'], f['mimeType'] == MIMETYPE_FOLDER, md5=f.get('md5Checksum'), modified_time=f.get('modifiedTime'))
+                    if child.is_directory and child.id == f['id']:
+                        next_level.append(child)
+            level = next_level
+        print(f"Indexed {self.get_path()}, got {len(self.index)} files")
+
+    def load_index(self, get_children):
+        # indexes the tree from known metadata instead of listing it, get_children returns
+        # the (id, name, is directory, md5, modified time) of the children of a folder
+        self.reset_index()
+        level = [self]
+        while level:
+            next_level = []
+            for folder in level:
+                for (id, name, is_directory, md5, modified_time) in get_children(folder):
+                    child = folder.add_child(name, id, is_directory, md5=md5, modified_time=modified_time)
+                    if child.is_directory and child.id == id:
+                        next_level.append(child)
+            level = next_level
+
+    def reset_index(self):
+        self.index = {}
+        self.index_key = ''
+        with self.lock:
+            self.children = {}
+
+    def remove(self, batch=None):
+        if batch is not None:
+            batch.add(self.get_path(), self.gdrive.delete_files_request(self.id), lambda response: self.forget())
+        else:
+            self.gdrive.delete_files(self.id)
+            self.forget()
+
+    def forget(self):
         if self.parent is not None:
-            self.parent.children = [f for f in self.parent.children if f != self]
+            with self.parent.lock:
+                if self.parent.children.get(self.name) is self:
+                    del self.parent.children[self.name]
+        self.remove_from_index()
+
+    def remove_from_index(self):
+        if self.index is None or self.index.get(self.index_key) is not self:
+            return
+        del self.index[self.index_key]
+        for child in (self.children or {}).values():
+            child.remove_from_index()
 
-    def upload_file(self, file_name, local_file):
+    def upload_file(self, file_name, local_file, md5=None):
+        # returns whether the file was uploaded, False if the remote file already had
+        # the content of the given md5, and the md5 of the content, None if the upload failed.
+        # Without md5 the file is hashed while it is uploaded
         if not self.is_directory:
             raise Exception(f"{self.get_path()} is not a directory")
         existing = self.get_child(file_name)
-        if existing is not None:
+        if existing is not None and existing.is_directory:
             existing.remove()
-            #self.gdrive.upload_existing_file(existing.id, local_file)
-            #return
-        file_id = self.gdrive.upload_file(self.id, file_name, local_file)
-        if file_id is not None and self.children is not None:
-            self.children.append(GDriveFile(self.gdrive, file_name, file_id, self, False))
+        elif existing is not None:
+            if md5 is None and existing.md5 is not None:
+                # the remote file may already be up to date, which is worth a read to know
+                md5 = hash_file(local_file, 'md5')
+            if md5 is not None and existing.md5 == md5:
+                return (False, md5)
+            existing.md5 = self.gdrive.upload_existing_file(existing.id, local_file)
+            if existing.md5 is not None:
+                stats.add('uploaded_bytes', os.path.getsize(local_file))
+            return (True, existing.md5)
+        (file_id, md5) = self.gdrive.upload_file(self.id, file_name, local_file)
+        if file_id is not None:
+            stats.add('uploaded_bytes', os.path.getsize(local_file))
+        with self.lock:
+            if file_id is not None and self.children is not None:
+                self.add_child(file_name, file_id, False, md5=md5)
+        return (True, md5)
     
     def download(self) -> pathlib.Path:
         temp_file = Common.get_temp_file("txt")
-        self.gdrive.download_file(self.id, temp_file)
+        with open(temp_file, 'wb') as f:
+            self.receive(f, self.md5)
         return temp_file
+
+    def download_to(self, destination, expected_md5=None, hasher=None, expected_hash=None):
+        # downloads to a temporary file next to destination, which is only replaced
+        # once the whole content arrived with the expected md5, and the expected hash with
+        # hasher if given. Returns the md5 of the content, or its hash with hasher
+        with Common.atomic_file(destination) as f:
+            if hasher is None:
+                return self.receive(f, expected_md5)
+            writer = HashingWriter(f, hasher)
+            self.receive(writer, expected_md5)
+            if expected_hash is not None and writer.hexdigest() != expected_hash:
+                raise Exception(f"Checksum mismatch downloading {self.get_path()}, expected {expected_hash} got {writer.hexdigest()}")
+            return writer.hexdigest()
+
+    def receive(self, f, expected_md5=None):
+        # the content is hashed as it arrives, returns its md5
+        writer = HashingWriter(f)
+        self.gdrive.download_file(self.id, writer)
+        if expected_md5 is not None and writer.hexdigest() != expected_md5:
+            raise Exception(f"Checksum mismatch downloading {self.get_path()}, expected {expected_md5} got {writer.hexdigest()}")
+        stats.add('downloaded_bytes', writer.size)
+        return writer.hexdigest()
@@ -0,0 +1,101 @@
+import json
+import os
+import pathlib
+import threading
+import time
+from .common import Common
+from .difftool import hash_file, DEFAULT_HASH_ALGORITHM
+
+# entries whose mtime is this close to the moment the cache was written cannot
+# be trusted: the file may be modified again without its mtime changing
+RACY_MTIME_WINDOW_NS = 2_000_000_000
+
+class HashCache:
+    VERSION = 1
+
+    def __init__(self, cache_file, algorithm=DEFAULT_HASH_ALGORITHM):
+        self.cache_file = pathlib.Path(cache_file)
+        self.algorithm = algorithm
+        self.entries = {}
+        self.seen = set()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        self.entries = {}
+        if not self.cache_file.is_file():
+            return
+        try:
+            content = json.loads(self.cache_file.read_text())
+        except (OSError, ValueError):
+            print(f"Ignoring corrupted hash cache {self.cache_file}")
+            return
+        # caches written before the algorithm was recorded have md5 hashes
+        if content.get('version') != HashCache.VERSION or content.get('algorithm', 'md5') != self.algorithm:
+            return
+        written_ns = content.get('written', 0)
+        for path, entry in content.get('entries', {}).items():
+            (size, mtime_ns, inode, file_hash) = entry
+            if written_ns - mtime_ns < RACY_MTIME_WINDOW_NS:
+                continue
+            self.entries[path] = (size, mtime_ns, inode, file_hash)
+
+    @staticmethod
+    def stat_key(stat):
+        return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    def get_cached_hash(self, rel_path, local_path):
+        # returns the cached hash of the file, or None without hashing it
+        key = HashCache.stat_key(os.stat(local_path))
+        with self.lock:
+            self.seen.add(rel_path)
+            entry = self.entries.get(rel_path)
+            if entry is not None and entry[:3] == key:
+                self.hits += 1
+                return entry[3]
+        return None
+
+    def add(self, rel_path, local_path, stat, file_hash):
+        # records a hash computed while transferring the file, stat must have been taken
+        # before its content was read or written
+        key = HashCache.stat_key(stat)
+        unchanged = HashCache.stat_key(os.stat(local_path)) == key
+        with self.lock:
+            self.seen.add(rel_path)
+            if unchanged:
+                self.entries[rel_path] = (*key, file_hash)
+            else:
+                self.entries.pop(rel_path, None)
+
+    def get_hash(self, rel_path, local_path):
+        key = HashCache.stat_key(os.stat(local_path))
+        with self.lock:
+            self.seen.add(rel_path)
+            entry = self.entries.get(rel_path)
+            if entry is not None and entry[:3] == key:
+                self.hits += 1
+                return entry[3]
+            self.misses += 1
+
+        file_hash = hash_file(local_path, self.algorithm)
+        unchanged = HashCache.stat_key(os.stat(local_path)) == key
+        with self.lock:
+            if unchanged:
+                self.entries[rel_path] = (*key, file_hash)
+            else:
+                # modified while being hashed, the hash may not match any version of the file
+                self.entries.pop(rel_path, None)
+        return file_hash
+
+    def keep(self, paths):
+        # keeps the entries of files that were not read again this time
+        with self.lock:
+            self.seen.update(paths)
+
+    def save(self):
+        entries = {path: entry for path, entry in self.entries.items() if path in self.seen}
+        content = json.dumps({ 'version': HashCache.VERSION, 'algorithm': self.algorithm, 'written': time.time_ns(), 'entries': entries })
+        Common.atomic_write(self.cache_file, content)
+
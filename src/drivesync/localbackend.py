@@ -0,0 +1,210 @@
+"""
+Storage backend keeping the remote copy in a local directory, to measure and
+test syncs without a drive account. Like drive it has a latency per request,
+a quota of requests per second (over which requests fail with a 429) and a
+bandwidth, all optional. Every request and transferred byte is counted.
+Its changes feed is the list of the ids of the files changed, a page token is
+a position in that list.
+"""
+
+import collections
+import datetime
+import hashlib
+import itertools
+import pathlib
+import shutil
+import threading
+import time
+from .googledrive import MIMETYPE_FOLDER
+from .ratelimit import AdaptiveRateLimiter, RequestError, RequestExecutor, DEFAULT_REQUESTS_PER_SECOND, MAX_REQUESTS_PER_SECOND
+from .storage import StorageBackend
+
+LIST_PAGE_SIZE = 1000
+COPY_BUFFER_SIZE = 1024 * 1024
+
+LocalRequest = collections.namedtuple('LocalRequest', 'operation function')
+
+def modified_time():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+class LocalBackend(StorageBackend):
+    def __init__(self, storage_dir, latency=0.0, quota=None, bandwidth=None, requests_per_second=DEFAULT_REQUESTS_PER_SECOND,
+                 max_requests_per_second=MAX_REQUESTS_PER_SECOND):
+        # latency in seconds per request, quota in requests per second, bandwidth in bytes per second
+        self.storage_dir = pathlib.Path(storage_dir)
+        self.storage_dir.mkdir(parents=True, exist_ok=True)
+        self.latency = latency
+        self.quota = quota
+        self.bandwidth = bandwidth
+        self._executor = RequestExecutor(AdaptiveRateLimiter(requests_per_second, max_rate=max_requests_per_second))
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.files = {}
+        self.children = collections.defaultdict(set)
+        self.changes = []
+        self.quota_tokens = quota or 0
+        self.quota_refill = time.monotonic()
+        self.calls = collections.Counter()
+        self.bytes_uploaded = 0
+        self.bytes_downloaded = 0
+
+    @property
+    def executor(self):
+        return self._executor
+
+    def consume_quota(self):
+        if self.quota is None:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.quota_tokens = min(self.quota, self.quota_tokens + (now - self.quota_refill) * self.quota)
+            self.quota_refill = now
+            if self.quota_tokens < 1:
+                return False
+            self.quota_tokens -= 1
+            return True
+
+    def call(self, request):
+        with self.lock:
+            self.calls[request.operation] += 1
+        time.sleep(self.latency)
+        if not self.consume_quota():
+            raise RequestError(429, 'userRateLimitExceeded')
+        return request.function()
+
+    def execute(self, request, description=None):
+        return self.executor.run(lambda: self.call(request), description, method=f"local.{request.operation}")
+
+    def execute_batch(self, requests):
+        with self.lock:
+            self.calls['batch'] += 1
+        # a batch is a single round trip, but each of its calls counts against the quota
+        time.sleep(self.latency)
+        responses = []
+        for request in requests:
+            with self.lock:
+                self.calls[request.operation] += 1
+            try:
+                if not self.consume_quota():
+                    raise RequestError(429, 'userRateLimitExceeded')
+                responses.append((request.function(), None))
+            except Exception as e:
+                responses.append((None, e))
+        return responses
+
+    def transfer_time(self, size):
+        if self.bandwidth:
+            time.sleep(size / self.bandwidth)
+
+    def get_file(self, file_id):
+        file = self.files.get(file_id)
+        if file is None:
+            raise RequestError(404, 'notFound')
+        return file
+
+    def add_file(self, name, parent_id, mime_type, md5=None):
+        with self.lock:
+            if parent_id is not None:
+                self.get_file(parent_id)
+            file_id = str(next(self.ids))
+            self.files[file_id] = { 'id': file_id, 'name': name, 'mimeType': mime_type, 'md5Checksum': md5,
+                                    'modifiedTime': modified_time(), 'parents': [parent_id] }
+            self.children[parent_id].add(file_id)
+            self.changes.append(file_id)
+        return file_id
+
+    def create_folder_request(self, folder_name, parent_folder_id=None):
+        return LocalRequest('create', lambda: { 'id': self.add_file(folder_name, parent_folder_id, MIMETYPE_FOLDER) })
+
+    def grant_user_permissions_request(self, file_id, user_email):
+        return LocalRequest('permissions', lambda: self.get_file(file_id))
+
+    def delete_files_request(self, file_or_folder_id):
+        return LocalRequest('delete', lambda: self.delete(file_or_folder_id))
+
+    def delete(self, file_id):
+        with self.lock:
+            file = self.get_file(file_id)
+            self.children[file['parents'][0]].discard(file_id)
+            removed = [file_id]
+            while removed:
+                file_id = removed.pop()
+                self.files.pop(file_id)
+                removed += self.children.pop(file_id, ())
+                self.storage_dir.joinpath(file_id).unlink(missing_ok=True)
+                self.changes.append(file_id)
+
+    def list_folder(self, parent_folder_id=None):
+        return [{k: v for (k, v) in f.items() if k != 'parents'} for f in self.list_folders([parent_folder_id])]
+
+    def list_folders(self, parent_folder_ids):
+        with self.lock:
+            ids = [file_id for parent_id in parent_folder_ids for file_id in sorted(self.children.get(parent_id, ()))]
+        # one request per page of results, like drive
+        for i in range(0, max(1, len(ids)), LIST_PAGE_SIZE):
+            yield from self.execute(LocalRequest('list', lambda: [dict(self.files[file_id]) for file_id in ids[i:i+LIST_PAGE_SIZE] if file_id in self.files]))
+
+    def get_changes_token(self):
+        with self.lock:
+            return str(len(self.changes))
+
+    def list_changes(self, page_token):
+        with self.lock:
+            end = len(self.changes)
+        changes = []
+        for i in range(int(page_token), max(int(page_token) + 1, end), LIST_PAGE_SIZE):
+            changes += self.execute(LocalRequest('changes', lambda: [self.get_change(file_id) for file_id in self.changes[i:min(end, i+LIST_PAGE_SIZE)]]))
+        return (changes, str(end))
+
+    def get_change(self, file_id):
+        with self.lock:
+            file = self.files.get(file_id)
+            if file is None:
+                return { 'fileId': file_id, 'removed': True }
+            return { 'fileId': file_id, 'removed': False, 'file': dict(file, trashed=False) }
+
+    def download_file(self, file_id, destination):
+        def download():
+            self.get_file(file_id)
+            with open(self.storage_dir.joinpath(file_id), 'rb') as source:
+                shutil.copyfileobj(source, destination, COPY_BUFFER_SIZE)
+                size = source.tell()
+            self.transfer_time(size)
+            with self.lock:
+                self.bytes_downloaded += size
+        self.execute(LocalRequest('download', download), f"Downloading {file_id}")
+
+    def store(self, file_id, local_file_path):
+        md5 = hashlib.md5()
+        with open(local_file_path, 'rb') as source, open(self.storage_dir.joinpath(file_id), 'wb') as destination:
+            while chunk := source.read(COPY_BUFFER_SIZE):
+                md5.update(chunk)
+                destination.write(chunk)
+        size = pathlib.Path(local_file_path).stat().st_size
+        self.transfer_time(size)
+        with self.lock:
+            self.bytes_uploaded += size
+            self.files[file_id].update(md5Checksum=md5.hexdigest(), modifiedTime=modified_time())
+            self.changes.append(file_id)
+        return self.files[file_id]
+
+    def upload_file(self, folder_id, file_name, local_file_path):
+        def upload():
+            file_id = self.add_file(file_name, folder_id, 'application/octet-stream')
+            return self.store(file_id, local_file_path)
+        try:
+            file = self.execute(LocalRequest('upload', upload), f"Uploading {local_file_path}")
+            return (file['id'], file['md5Checksum'])
+        except RequestError as error:
+            print(f"An error occurred while uploading {file_name}: {error}")
+            return (None, None)
+
+    def upload_existing_file(self, file_id, local_file_path):
+        def upload():
+            self.get_file(file_id)
+            return self.store(file_id, local_file_path)
+        try:
+            return self.execute(LocalRequest('update', upload), f"Uploading {local_file_path}")['md5Checksum']
+        except RequestError as error:
+            print(f"An error occurred while uploading {file_id}: {error}")
+            return None
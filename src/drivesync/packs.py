@@ -0,0 +1,81 @@
+"""
+Small files packing.
+
+When enabled, files smaller than a threshold are not uploaded one by one but
+grouped in zip archives stored in the remote PACKS_DIRECTORY. Members are named
+by their hash, so identical files are stored once, and packs are named by the
+hash of their content and their number of members: <hash>-<members>.zip.
+The state records the pack of every packed file, which is all that is needed
+to know how many members of a pack are still alive: once the dead share of a
+pack exceeds a threshold its live members are moved to a new pack and the old
+one is deleted.
+"""
+
+import collections
+import hashlib
+import zipfile
+from .common import Common
+
+PACKS_DIRECTORY = 'drivestate.packs'
+DEFAULT_PACK_SIZE = 16 * 1024 * 1024
+DEFAULT_REPACK_DEAD_RATIO = 0.5
+# fixed member timestamps, so that the same members always make the same pack
+MEMBER_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+def pack_member_count(pack_name):
+    return int(pack_name[:-len('.zip')].rsplit('-', 1)[1])
+
+def write_pack(members):
+    # members is a dict hash -> content, returns the pack file and its name
+    pack_file = Common.get_temp_file('zip')
+    with zipfile.ZipFile(pack_file, 'w', zipfile.ZIP_DEFLATED) as pack:
+        for file_hash in sorted(members):
+            pack.writestr(zipfile.ZipInfo(file_hash, MEMBER_DATE_TIME), members[file_hash])
+    content_hash = hashlib.sha256(pack_file.read_bytes()).hexdigest()[:32]
+    return (pack_file, f"{content_hash}-{len(members)}.zip")
+
+def read_members(pack_file, file_hashes):
+    with zipfile.ZipFile(pack_file) as pack:
+        return {file_hash: pack.read(file_hash) for file_hash in file_hashes}
+
+def live_members(state):
+    # pack name -> hashes of the files that reference it
+    members = collections.defaultdict(set)
+    for f in state:
+        if f.pack is not None:
+            members[f.pack].add(f.file_hash)
+    return members
+
+def packs_to_repack(packs, live, dead_ratio):
+    return [pack for pack in packs if len(live.get(pack, ())) < pack_member_count(pack) * (1 - dead_ratio)]
+
+def carry_packs(state, reference_state):
+    # files of state that have the same content as in reference_state keep its pack
+    reference = {f.path: f for f in reference_state}
+    for f in state:
+        ref = reference.get(f.path)
+        if ref is not None and ref.file_hash == f.file_hash and not f.is_directory:
+            f.pack = ref.pack
+
+class PackBuilder:
+    def __init__(self, pack_size):
+        self.pack_size = pack_size
+        self.packs = []
+        self.members = {}
+        self.members_size = 0
+
+    def add(self, file_hash, content):
+        if file_hash in self.members:
+            return
+        self.members[file_hash] = content
+        self.members_size += len(content)
+        if self.members_size >= self.pack_size:
+            self.flush()
+
+    def flush(self):
+        # returns the packs built so far, as (pack file, pack name, member hashes)
+        if self.members:
+            (pack_file, pack_name) = write_pack(self.members)
+            self.packs.append((pack_file, pack_name, set(self.members)))
+            (self.members, self.members_size) = ({}, 0)
+        return self.packs
@@ -0,0 +1,179 @@
+"""
+Retries and rate limiting of drive api requests.
+
+Every request goes through a RequestExecutor, which waits for the rate limiter
+before sending it and retries it with exponential backoff and jitter when
+drive answers that it is throttled (429, or 403 with a rate limit reason) or
+failed transiently (5xx).
+The rate limiter is a token bucket whose rate adapts like tcp congestion
+control: it doubles every second while requests succeed (slow start), until
+drive first throttles them, then it grows slowly and is halved whenever drive
+throttles again, so bulk syncs run just below the quota. The rate only grows
+while it actually holds requests back, it stays near what the sync needs.
+"""
+
+import json
+import random
+import sys
+import threading
+import time
+from .stats import stats
+
+RATE_LIMIT_REASONS = ('userRateLimitExceeded', 'rateLimitExceeded', 'sharingRateLimitExceeded')
+TRANSIENT_STATUSES = (500, 502, 503, 504)
+
+# half of the default per user quota of drive, 12000 requests per minute
+DEFAULT_REQUESTS_PER_SECOND = 100.0
+MIN_REQUESTS_PER_SECOND = 0.5
+# no cap by default, the rate is bounded by the throttling of drive
+MAX_REQUESTS_PER_SECOND = None
+# requests that may be sent at once after the bucket was idle
+BURST_SECONDS = 1.0
+# after the first throttling, the rate grows by this many requests per second every second
+RATE_INCREASE = 1.0
+# the rate only grows if requests waited for the limiter this recently
+GROWTH_WINDOW_SECONDS = 1.0
+RATE_DECREASE_FACTOR = 0.5
+# requests in flight when the rate was decreased were sent at the old rate and
+# may be throttled too, they must not decrease it again
+DECREASE_COOLDOWN_SECONDS = 1.0
+
+MAX_RETRIES = 8
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 64.0
+
+class RequestError(Exception):
+    """
+    An api error of a backend that does not use the google libraries, retried
+    like an HttpError of the same status and reason.
+    """
+
+    def __init__(self, status, reason=None):
+        super().__init__(f"{status} {reason or ''}".strip())
+        self.status = status
+        self.reason = reason
+
+def error_reason(error):
+    try:
+        content = json.loads(error.content)
+        return content['error']['errors'][0]['reason']
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+def error_status(error):
+    # the (status, reason) of an api error, (None, None) for other errors
+    if isinstance(error, RequestError):
+        return (error.status, error.reason)
+    # an HttpError can only have been raised once the google libraries were loaded
+    errors = sys.modules.get('googleapiclient.errors')
+    if errors is not None and isinstance(error, errors.HttpError):
+        return (error.resp.status, error_reason(error))
+    return (None, None)
+
+def is_rate_limited(error):
+    (status, reason) = error_status(error)
+    return status == 429 or (status == 403 and reason in RATE_LIMIT_REASONS)
+
+def is_retryable(error):
+    if is_rate_limited(error):
+        return True
+    (status, _) = error_status(error)
+    if status is not None:
+        return status in TRANSIENT_STATUSES
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+def is_not_found(error):
+    return error_status(error)[0] == 404
+
+def backoff_delay(attempt):
+    # full jitter, spreads the retries of the threads throttled at the same time
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+class AdaptiveRateLimiter:
+    def __init__(self, rate=DEFAULT_REQUESTS_PER_SECOND, min_rate=MIN_REQUESTS_PER_SECOND, max_rate=MAX_REQUESTS_PER_SECOND):
+        self.min_rate = min_rate
+        self.max_rate = float('inf') if max_rate is None else max(min_rate, max_rate)
+        self.rate = min(max(rate, self.min_rate), self.max_rate)
+        self.slow_start = True
+        self.last_wait = float('-inf')
+        self.lock = threading.Lock()
+        self.tokens = self.rate * BURST_SECONDS
+        self.last_refill = time.monotonic()
+        self.last_decrease = float('-inf')
+        self.throttled = 0
+
+    def acquire(self, count=1):
+        # takes count tokens, waiting for them if needed. The tokens are taken
+        # right away so that the threads waiting at the same time are queued
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate * BURST_SECONDS, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            self.tokens -= count
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            if wait > 0:
+                self.last_wait = now
+        if wait > 0:
+            stats.add('rate_limit_wait_seconds', wait)
+            time.sleep(wait)
+
+    def on_success(self, count=1):
+        with self.lock:
+            if time.monotonic() - self.last_wait > GROWTH_WINDOW_SECONDS:
+                return
+            # in slow start each success adds a request per second, the rate doubles
+            # once a second of requests succeeded
+            increase = count if self.slow_start else RATE_INCREASE * count / self.rate
+            self.rate = min(self.max_rate, self.rate + increase)
+
+    def on_throttled(self):
+        with self.lock:
+            self.throttled += 1
+            self.slow_start = False
+            now = time.monotonic()
+            if now - self.last_decrease < DECREASE_COOLDOWN_SECONDS:
+                return
+            self.last_decrease = now
+            self.rate = max(self.min_rate, self.rate * RATE_DECREASE_FACTOR)
+            # what was left in the bucket was computed at the old rate
+            self.tokens = min(self.tokens, 0)
+
+
+class RequestExecutor:
+    def __init__(self, limiter=None, max_retries=MAX_RETRIES):
+        self.limiter = limiter or AdaptiveRateLimiter()
+        self.max_retries = max_retries
+
+    def run(self, function, description=None, cost=1, on_retry=None, method='request'):
+        # calls function until it succeeds, a non retryable error or max_retries
+        # retries. cost is the number of api calls it makes, on_retry is called
+        # before retrying, to reset what the failed attempt left behind.
+        # Each attempt is recorded in the stats under method
+        attempt = 0
+        while True:
+            self.limiter.acquire(cost)
+            start = time.perf_counter()
+            try:
+                result = function()
+            except Exception as error:
+                throttled = is_rate_limited(error)
+                stats.record_request(method, time.perf_counter() - start, cost, error=True, throttled=throttled)
+                if not is_retryable(error) or attempt >= self.max_retries:
+                    raise
+                if throttled:
+                    self.limiter.on_throttled()
+                delay = backoff_delay(attempt)
+                stats.add('backoff_seconds', delay)
+                attempt += 1
+                print(f"{description or 'Request'} failed ({error}), retrying in {delay:.1f}s ({attempt}/{self.max_retries})")
+                time.sleep(delay)
+                if on_retry is not None:
+                    on_retry()
+                continue
+            stats.record_request(method, time.perf_counter() - start, cost)
+            self.limiter.on_success(cost)
+            return result
+
+    def execute(self, request, description=None):
+        return self.run(request.execute, description, method=request.methodId)
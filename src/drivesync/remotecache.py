@@ -0,0 +1,127 @@
+"""
+Local copy of the metadata of the remote tree: the id, name, md5 and
+modification time of every file under the sync root, so that syncs do not
+list the whole tree again.
+
+It is kept up to date with the changes feed of the backend. The cache stores
+the page token of the changes that came after it was written, the next sync
+fetches only these changes and applies them. Changes are applied by id, so
+applying one twice does nothing, and they may be replayed from a token taken
+before the cache was written.
+"""
+
+import json
+import pathlib
+from .common import Common
+from .googledrive import GDriveFile, INDEX_FOLDERS_PER_QUERY, MIMETYPE_FOLDER
+
+CACHE_VERSION = 1
+
+class RemoteCache:
+    def __init__(self, cache_file, sync_name):
+        self.cache_file = pathlib.Path(cache_file)
+        self.sync_name = sync_name
+        self.root_id = None
+        self.page_token = None
+        # id -> (parent id, name, is directory, md5, modified time) of every file under the root
+        self.entries = {}
+
+    def load(self):
+        # returns whether there was a cache of this sync root
+        if not self.cache_file.is_file():
+            return False
+        try:
+            content = json.loads(self.cache_file.read_text())
+        except (OSError, ValueError):
+            print(f"Ignoring corrupted remote cache {self.cache_file}")
+            return False
+        if content.get('version') != CACHE_VERSION or content.get('sync-name') != self.sync_name:
+            return False
+        self.root_id = content['root']
+        self.page_token = content['page-token']
+        self.entries = {file_id: tuple(entry) for (file_id, entry) in content['entries'].items()}
+        return True
+
+    def save(self):
+        content = { 'version': CACHE_VERSION, 'sync-name': self.sync_name, 'root': self.root_id,
+                    'page-token': self.page_token, 'entries': self.entries }
+        Common.atomic_write(self.cache_file, json.dumps(content))
+
+    @staticmethod
+    def entry(f, parent_id):
+        return (parent_id, f['name'], f['mimeType'] == MIMETYPE_FOLDER, f.get('md5Checksum'), f.get('modifiedTime'))
+
+    def rebuild(self, backend, sync_root):
+        # lists the whole tree. The changes made while it is listed come after the token
+        # and are applied again by the next update
+        page_token = backend.get_changes_token()
+        sync_root.index_tree()
+        self.root_id = sync_root.id
+        self.page_token = page_token
+        self.entries = {f.id: (f.parent.id, f.name, f.is_directory, f.md5, f.modified_time) for f in sync_root.index.values()}
+
+    def update(self, backend):
+        # applies the changes made since the cache was written, returns False if the
+        # cache cannot be brought up to date and must be rebuilt
+        (changes, page_token) = backend.list_changes(self.page_token)
+        known_directories = {file_id for (file_id, entry) in self.entries.items() if entry[2]}
+        for change in changes:
+            file_id = change['fileId']
+            f = change.get('file')
+            removed = change.get('removed') or f is None or f.get('trashed')
+            if file_id == self.root_id:
+                if removed or f['name'] != self.sync_name:
+                    print(f"Sync root {self.sync_name} was removed or renamed")
+                    return False
+            elif removed or not f.get('parents'):
+                self.entries.pop(file_id, None)
+            else:
+                self.entries[file_id] = RemoteCache.entry(f, f['parents'][0])
+        # changes were applied in any order, what ended up outside of the tree is dropped once they all were
+        self.prune()
+
+        # a directory entering the tree may have been moved in with its content, which has no changes
+        added_directories = [file_id for (file_id, entry) in self.entries.items() if entry[2] and file_id not in known_directories]
+        if added_directories:
+            self.list_directories(backend, added_directories)
+        self.page_token = page_token
+        print(f"Applied {len(changes)} remote changes, listed {len(added_directories)} new directories")
+        return True
+
+    def list_directories(self, backend, directory_ids):
+        listed = set()
+        level = directory_ids
+        while level:
+            listed.update(level)
+            next_level = []
+            for i in range(0, len(level), INDEX_FOLDERS_PER_QUERY):
+                folder_ids = set(level[i:i+INDEX_FOLDERS_PER_QUERY])
+                for f in backend.list_folders(folder_ids):
+                    parent_id = next(p for p in f['parents'] if p in folder_ids)
+                    self.entries[f['id']] = RemoteCache.entry(f, parent_id)
+                    if f['mimeType'] == MIMETYPE_FOLDER and f['id'] not in listed:
+                        next_level.append(f['id'])
+            level = next_level
+
+    def children(self):
+        # parent id -> ids of its children
+        children = {}
+        for (file_id, entry) in self.entries.items():
+            children.setdefault(entry[0], []).append(file_id)
+        return children
+
+    def prune(self):
+        children = self.children()
+        reachable = set()
+        level = [self.root_id]
+        while level:
+            level = [file_id for parent_id in level for file_id in children.get(parent_id, ())]
+            reachable.update(level)
+        self.entries = {file_id: entry for (file_id, entry) in self.entries.items() if file_id in reachable}
+
+    def build_tree(self, backend):
+        # returns the sync root with the whole tree indexed from the cache, without listing it
+        sync_root = GDriveFile(backend, self.sync_name, self.root_id, GDriveFile.get_root(backend))
+        children = self.children()
+        sync_root.load_index(lambda folder: [(file_id, *self.entries[file_id][1:]) for file_id in sorted(children.get(folder.id, ()))])
+        return sync_root
@@ -0,0 +1,112 @@
+"""
+The remote state is stored in the sync root as a snapshot followed by
+append-only delta segments, each push uploads a single delta:
+
+drivestate.snapshot.<sequence>  the full state, up to <sequence> included
+drivestate.delta.<sequence>     the files added or changed by a push, and the
+                                paths it removed in its metadata
+
+Once COMPACTION_SEGMENTS deltas accumulated after the snapshot, the next push
+folds them in a new snapshot and deletes the older segments. A state file left
+by an older version of drivesync is read as a snapshot of sequence 0.
+Segments record the hash algorithm of their files, all the segments of a sync
+must have the same.
+"""
+
+import re
+from . import difftool, stateformat
+from .common import Common
+from .difftool import StateFile, DEFAULT_HASH_ALGORITHM
+
+SNAPSHOT_PREFIX = 'drivestate.snapshot.'
+DELTA_PREFIX = 'drivestate.delta.'
+COMPACTION_SEGMENTS = 32
+
+def segment_sequence(name, prefixes=(SNAPSHOT_PREFIX, DELTA_PREFIX)):
+    # the sequence of a segment named with one of prefixes, None for other files.
+    # Users may have files named like segments in the sync root, drivestate.delta.old
+    for prefix in prefixes:
+        if name.startswith(prefix) and re.fullmatch('[0-9]+', name[len(prefix):]):
+            return int(name[len(prefix):])
+    return None
+
+class RemoteState:
+    def __init__(self, gdrive_root, legacy_file_names, hash_algorithm=DEFAULT_HASH_ALGORITHM):
+        self.gdrive_root = gdrive_root
+        self.legacy_file_names = legacy_file_names
+        self.hash_algorithm = hash_algorithm
+
+    def list_segments(self):
+        # returns (snapshot sequence, snapshot file) and the delta files by sequence
+        (snapshot, snapshot_sequence) = (None, None)
+        deltas = {}
+        for f in self.gdrive_root.get_children():
+            delta_sequence = segment_sequence(f.name, (DELTA_PREFIX,))
+            sequence = segment_sequence(f.name, (SNAPSHOT_PREFIX,))
+            if delta_sequence is not None:
+                deltas[delta_sequence] = f
+            elif sequence is not None and (snapshot_sequence is None or sequence > snapshot_sequence):
+                (snapshot, snapshot_sequence) = (f, sequence)
+        if snapshot is None:
+            for name in self.legacy_file_names:
+                snapshot = self.gdrive_root.get_child(name)
+                if snapshot is not None:
+                    snapshot_sequence = 0
+                    break
+        return (snapshot_sequence, snapshot, deltas)
+
+    def fetch(self, known_state=None, known_sequence=None):
+        # returns the remote state and its sequence, when the state at known_sequence
+        # is given only the deltas that came after it are downloaded
+        (snapshot_sequence, snapshot, deltas) = self.list_segments()
+        if known_sequence is not None and known_sequence >= (snapshot_sequence or 0):
+            (state, sequence) = (known_state, known_sequence)
+        elif snapshot is not None:
+            (state, sequence) = (self.read_segment(snapshot)[0], snapshot_sequence)
+        else:
+            (state, sequence) = ([], 0)
+
+        for delta_sequence in sorted(s for s in deltas if s > sequence):
+            state = difftool.merge_diff(state, self.read_delta(deltas[delta_sequence]))
+            sequence = delta_sequence
+        return (state, sequence)
+
+    def read_segment(self, segment_file):
+        (state, metadata) = stateformat.read_state(segment_file.download())
+        # segments written before the algorithm was recorded have md5 hashes
+        if metadata.get('hash-algorithm', 'md5') != self.hash_algorithm:
+            raise Exception(f"Remote {segment_file.name} is hashed with {metadata.get('hash-algorithm', 'md5')}, the sync uses {self.hash_algorithm}")
+        return (state, metadata)
+
+    def read_delta(self, delta_file):
+        (changed, metadata) = self.read_segment(delta_file)
+        removed = [StateFile(path, False) for path in metadata.get('removed', [])]
+        return ([], removed, changed)
+
+    def append(self, applied_diff):
+        # uploads the diff as a new delta, returns its sequence
+        (new, removed, changed) = applied_diff
+        (snapshot_sequence, snapshot, deltas) = self.list_segments()
+        sequence = max([snapshot_sequence or 0, *deltas]) + 1
+        delta_file = Common.get_temp_file('bin')
+        stateformat.write_state(delta_file, new + changed, { 'sequence': sequence, 'hash-algorithm': self.hash_algorithm, 'removed': [f.path for f in removed] })
+        self.gdrive_root.upload_file(f"{DELTA_PREFIX}{sequence}", delta_file)
+
+        if len(deltas) + 1 >= COMPACTION_SEGMENTS:
+            self.compact()
+        return sequence
+
+    def compact(self):
+        (snapshot_sequence, snapshot, deltas) = self.list_segments()
+        (state, sequence) = self.fetch()
+        print(f"Compacting remote state up to {sequence}")
+        snapshot_file = Common.get_temp_file('bin')
+        stateformat.write_state(snapshot_file, state, { 'sequence': sequence, 'hash-algorithm': self.hash_algorithm })
+        self.gdrive_root.upload_file(f"{SNAPSHOT_PREFIX}{sequence}", snapshot_file)
+
+        with self.gdrive_root.gdrive.batch() as batch:
+            if snapshot is not None:
+                snapshot.remove(batch)
+            for delta_sequence in deltas:
+                if delta_sequence <= sequence:
+                    deltas[delta_sequence].remove(batch)
@@ -0,0 +1,158 @@
+"""
+Binary state file format.
+
+header   magic 'DSST' | version u8 | metadata length u32 | metadata (json)
+records  flags u8 | path length u16 | path (utf8) | [hash length u8 | hash] | [pack length u8 | pack]
+index    every INDEX_STRIDE-th record: path length u16 | path | record offset u64
+footer   index offset u64 | index length u32 | magic 'DSIX'
+
+Records are sorted by path, so all the paths sharing a prefix are contiguous
+and can be found through the sparse index without reading the whole file.
+"""
+
+import bisect
+import io
+import json
+import struct
+from .common import Common
+from .difftool import StateFile, parse_state
+
+STATE_MAGIC = b'DSST'
+INDEX_MAGIC = b'DSIX'
+STATE_VERSION = 2
+# version 1 had no packs
+SUPPORTED_STATE_VERSIONS = (1, 2)
+INDEX_STRIDE = 64
+
+FLAG_DIRECTORY = 1
+FLAG_HAS_HASH = 2
+FLAG_PACKED = 4
+
+HEADER = struct.Struct('<4sBI')
+RECORD = struct.Struct('<BH')
+INDEX_ENTRY = struct.Struct('<HQ')
+FOOTER = struct.Struct('<QI4s')
+
+def serialize_state(state, metadata=None):
+    out = io.BytesIO()
+    metadata_bytes = json.dumps(metadata or {}).encode()
+    out.write(HEADER.pack(STATE_MAGIC, STATE_VERSION, len(metadata_bytes)))
+    out.write(metadata_bytes)
+
+    index = []
+    for (i, f) in enumerate(sorted(state, key=lambda f: f.path)):
+        path = f.path.encode()
+        if i % INDEX_STRIDE == 0:
+            index.append((path, out.tell()))
+        flags = (FLAG_DIRECTORY if f.is_directory else 0) | (FLAG_HAS_HASH if f.file_hash is not None else 0) | (FLAG_PACKED if f.pack is not None else 0)
+        out.write(RECORD.pack(flags, len(path)))
+        out.write(path)
+        if f.file_hash is not None:
+            file_hash = bytes.fromhex(f.file_hash)
+            out.write(bytes([len(file_hash)]))
+            out.write(file_hash)
+        if f.pack is not None:
+            pack = f.pack.encode()
+            out.write(bytes([len(pack)]))
+            out.write(pack)
+
+    index_offset = out.tell()
+    for (path, offset) in index:
+        out.write(INDEX_ENTRY.pack(len(path), offset))
+        out.write(path)
+    out.write(FOOTER.pack(index_offset, len(index), INDEX_MAGIC))
+    return out.getvalue()
+
+def write_state(path, state, metadata=None):
+    Common.atomic_write(path, serialize_state(state, metadata))
+
+def is_binary_state(path):
+    with open(path, 'rb') as f:
+        return f.read(len(STATE_MAGIC)) == STATE_MAGIC
+
+def read_state(path):
+    # reads a state file, either binary or in the legacy comma separated text format
+    # returns the state and its metadata
+    if not is_binary_state(path):
+        with open(path) as f:
+            return (parse_state(f.read()), {})
+    with StateReader(path) as reader:
+        return (list(reader), reader.metadata)
+
+
+class StateReader:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        (magic, version, metadata_length) = HEADER.unpack(self.file.read(HEADER.size))
+        if magic != STATE_MAGIC:
+            raise Exception(f"{path} is not a state file")
+        if version not in SUPPORTED_STATE_VERSIONS:
+            raise Exception(f"{path} has an unsupported state version {version}")
+        self.metadata = json.loads(self.file.read(metadata_length))
+        self.records_offset = self.file.tell()
+
+        self.file.seek(-FOOTER.size, io.SEEK_END)
+        (self.index_offset, self.index_length, magic) = FOOTER.unpack(self.file.read(FOOTER.size))
+        if magic != INDEX_MAGIC:
+            raise Exception(f"{path} is truncated")
+        self.index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def __iter__(self):
+        return self.iter_from(self.records_offset)
+
+    def iter_from(self, offset):
+        self.file.seek(offset)
+        while offset < self.index_offset:
+            (flags, path_length) = RECORD.unpack(self.file.read(RECORD.size))
+            path = self.file.read(path_length).decode()
+            offset += RECORD.size + path_length
+            file_hash = None
+            if flags & FLAG_HAS_HASH:
+                hash_length = self.file.read(1)[0]
+                file_hash = self.file.read(hash_length).hex()
+                offset += 1 + hash_length
+            pack = None
+            if flags & FLAG_PACKED:
+                pack_length = self.file.read(1)[0]
+                pack = self.file.read(pack_length).decode()
+                offset += 1 + pack_length
+            yield StateFile(path, bool(flags & FLAG_DIRECTORY), file_hash, pack)
+
+    def load_index(self):
+        if self.index is not None:
+            return
+        self.file.seek(self.index_offset)
+        (paths, offsets) = ([], [])
+        for _ in range(self.index_length):
+            (path_length, offset) = INDEX_ENTRY.unpack(self.file.read(INDEX_ENTRY.size))
+            paths.append(self.file.read(path_length).decode())
+            offsets.append(offset)
+        self.index = (paths, offsets)
+
+    def iter_prefix(self, prefix):
+        # yields the files whose path starts with prefix, only reading the records around them
+        self.load_index()
+        (paths, offsets) = self.index
+        block = max(0, bisect.bisect_right(paths, prefix) - 1)
+        if not offsets:
+            return
+        for f in self.iter_from(offsets[block]):
+            if f.path.startswith(prefix):
+                yield f
+            elif f.path > prefix:
+                return
+
+    def get(self, path):
+        for f in self.iter_prefix(path):
+            if f.path == path:
+                return f
+        return None
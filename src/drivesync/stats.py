@@ -0,0 +1,86 @@
+"""
+Instrumentation of a sync, to know where its time went.
+
+phases    wall time of each step of a sync (scan, remote index, transfers...)
+api       per api method: round trips, calls (a batch makes many), errors,
+          throttled responses and latency
+counters  totals summed across threads: bytes up and down, time spent hashing
+          or waiting for the rate limiter...
+
+drivesync prints them with --stats and dumps them as json with --stats-json.
+"""
+
+import collections
+import contextlib
+import json
+import threading
+import time
+
+class Stats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.phases = collections.defaultdict(float)
+        self.api = collections.defaultdict(lambda: { 'requests': 0, 'calls': 0, 'errors': 0, 'throttled': 0, 'seconds': 0.0, 'max_seconds': 0.0 })
+        self.counters = collections.defaultdict(float)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            self.phases[name] += seconds
+
+    def record_request(self, method, seconds, calls=1, error=False, throttled=False):
+        with self.lock:
+            api = self.api[method]
+            api['requests'] += 1
+            api['calls'] += calls
+            api['errors'] += int(error)
+            api['throttled'] += int(throttled)
+            api['seconds'] += seconds
+            api['max_seconds'] = max(api['max_seconds'], seconds)
+
+    def add(self, counter, value):
+        with self.lock:
+            self.counters[counter] += value
+
+    def summary(self):
+        with self.lock:
+            return {
+                'elapsed_seconds': time.perf_counter() - self.start,
+                'phases': dict(self.phases),
+                'api': {method: dict(api) for (method, api) in sorted(self.api.items())},
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def report(self):
+        summary = self.summary()
+        lines = [f"Elapsed {summary['elapsed_seconds']:.2f}s"]
+        lines += [f"  {name:<24} {seconds:9.2f}s" for (name, seconds) in summary['phases'].items()]
+        if summary['api']:
+            lines.append("API requests")
+            for (method, api) in summary['api'].items():
+                average = api['seconds'] / api['requests'] * 1000
+                lines.append(f"  {method:<32} {api['requests']:6} requests {api['calls']:7} calls {api['errors']:4} errors "
+                             f"{api['throttled']:4} throttled  avg {average:7.1f}ms  max {api['max_seconds']*1000:7.1f}ms")
+        if summary['counters']:
+            lines.append("Counters")
+            lines += [f"  {name:<24} {value:14.2f}" if isinstance(value, float) and not value.is_integer() else f"  {name:<24} {int(value):11}"
+                      for (name, value) in summary['counters'].items()]
+        return '\n'.join(lines)
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+# shared by the whole process
+stats = Stats()
@@ -0,0 +1,164 @@
+"""
+Storage backends, where drivesync keeps the remote copy of a sync.
+
+GDriveFile and DriveSync only talk to their backend through StorageBackend.
+Metadata operations come in two forms: a *_request method returns an opaque
+request, to run with execute() or to add to a batch, and a plain method runs it
+right away. Files are identified by the ids the backend gives them, the root of
+the backend has the id None.
+"""
+
+import abc
+import time
+from .ratelimit import backoff_delay, is_rate_limited, is_retryable
+from .stats import stats
+
+# maximum number of calls in a single batch request, set by the drive api
+BATCH_MAX_REQUESTS = 100
+
+class StorageBackend(abc.ABC):
+    # set by DriveSync, backends that support resumable uploads record them in it
+    upload_journal = None
+
+    @property
+    @abc.abstractmethod
+    def executor(self):
+        # the RequestExecutor of the requests of the backend, batches are retried through it
+        pass
+
+    @abc.abstractmethod
+    def execute(self, request, description=None):
+        pass
+
+    @abc.abstractmethod
+    def execute_batch(self, requests):
+        # sends requests together, returns a (response, exception) pair for each of them
+        pass
+
+    def batch(self):
+        return Batch(self)
+
+    @abc.abstractmethod
+    def create_folder_request(self, folder_name, parent_folder_id=None):
+        # the response of the request has the 'id' of the folder
+        pass
+
+    def create_folder(self, folder_name, parent_folder_id=None):
+        return self.execute(self.create_folder_request(folder_name, parent_folder_id), f"Creating folder {folder_name}")['id']
+
+    @abc.abstractmethod
+    def grant_user_permissions_request(self, file_id, user_email):
+        pass
+
+    def grant_user_permissions(self, file_id, user_email):
+        self.execute(self.grant_user_permissions_request(file_id, user_email), f"Sharing with {user_email}")
+
+    @abc.abstractmethod
+    def delete_files_request(self, file_or_folder_id):
+        pass
+
+    def delete_files(self, file_or_folder_id):
+        try:
+            self.execute(self.delete_files_request(file_or_folder_id), f"Deleting {file_or_folder_id}")
+        except Exception as e:
+            print(f"Error deleting file/folder with ID: {file_or_folder_id}: {str(e)}")
+
+    @abc.abstractmethod
+    def list_folder(self, parent_folder_id=None):
+        # returns the children of a folder as dicts with 'id', 'name', 'mimeType', 'md5Checksum' and 'modifiedTime'
+        pass
+
+    @abc.abstractmethod
+    def list_folders(self, parent_folder_ids):
+        # returns the children of many folders, like list_folder with their 'parents'
+        pass
+
+    @abc.abstractmethod
+    def get_changes_token(self):
+        # returns the page token of the changes that will be made from now on
+        pass
+
+    @abc.abstractmethod
+    def list_changes(self, page_token):
+        # returns the changes made since page_token and the token of the changes that come after them.
+        # A change has the 'fileId', whether the file was 'removed' and, if not, the 'file' like
+        # list_folders returns it with whether it is 'trashed'
+        pass
+
+    @abc.abstractmethod
+    def download_file(self, file_id, destination):
+        # writes the content of a file to destination, a binary file object
+        pass
+
+    @abc.abstractmethod
+    def upload_file(self, folder_id, file_name, local_file_path):
+        # returns the id and md5 of the new file, or (None, None) if the upload failed.
+        # The md5 must be the one of the content that was read, not only the one the remote computed
+        pass
+
+    @abc.abstractmethod
+    def upload_existing_file(self, file_id, local_file_path):
+        # replaces the content of a file, returns its new md5 or None if the upload failed
+        pass
+
+
+class Batch:
+    """
+    Groups metadata requests (deletions, folder creations, permissions...) into
+    batch requests of up to BATCH_MAX_REQUESTS calls. Each request is added with
+    a key, usually the path it applies to, failed requests are reported in
+    'errors' under that key. Callbacks of successful requests are invoked once
+    their batch completed, from the thread that flushed it.
+    The drive api does not guarantee the order in which the calls of a batch
+    are executed, requests that depend on each other must be in different batches.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.pending = []
+        self.errors = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, key, request, on_success=None):
+        self.pending.append((key, request, on_success))
+        if len(self.pending) >= BATCH_MAX_REQUESTS:
+            self.flush()
+
+    def flush(self):
+        # calls that were throttled or failed transiently are sent again in another
+        # batch, after a backoff, until they succeed or run out of retries
+        requests, self.pending = self.pending, []
+        executor = self.backend.executor
+        attempt = 0
+        while requests:
+            # each call of a batch counts against the quota
+            responses = executor.run(lambda: self.backend.execute_batch([request for (key, request, on_success) in requests]),
+                                     f"Batch of {len(requests)} requests", cost=len(requests), method='batch')
+
+            retries = []
+            throttled = False
+            for ((key, request, on_success), (response, exception)) in zip(requests, responses):
+                if exception is not None and is_retryable(exception) and attempt < executor.max_retries:
+                    retries.append((key, request, on_success))
+                    throttled = throttled or is_rate_limited(exception)
+                elif exception is not None:
+                    print(f"An error occurred on {key}: {exception}")
+                    self.errors[key] = exception
+                elif on_success is not None:
+                    on_success(response)
+            if retries:
+                if throttled:
+                    executor.limiter.on_throttled()
+                delay = backoff_delay(attempt)
+                stats.add('backoff_seconds', delay)
+                stats.add('batch_retried_calls', len(retries))
+                attempt += 1
+                print(f"{len(retries)} requests of a batch failed, retrying in {delay:.1f}s ({attempt}/{executor.max_retries})")
+                time.sleep(delay)
+            requests = retries
@@ -0,0 +1,74 @@
+"""
+File wrappers hashing the bytes that go through them, so that transfers hash
+files in the same pass that reads or writes them.
+"""
+
+import hashlib
+import os
+
+CATCH_UP_BUFFER_SIZE = 1024 * 1024
+
+class HashingReader:
+    """
+    Wraps a binary file open for reading. Reads may go back (a chunk sent again)
+    or skip ahead (a resumed upload), every byte is still hashed once and in order.
+    """
+
+    def __init__(self, file, hasher=None):
+        self.file = file
+        self.hasher = hashlib.md5() if hasher is None else hasher
+        self.hashed = 0
+
+    @property
+    def name(self):
+        return self.file.name
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def read(self, size=-1):
+        position = self.file.tell()
+        if position > self.hashed:
+            self.catch_up(position)
+        data = self.file.read(size)
+        end = position + len(data)
+        if end > self.hashed:
+            self.hasher.update(memoryview(data)[self.hashed - position:])
+            self.hashed = end
+        return data
+
+    def catch_up(self, position):
+        # hashes the bytes that were skipped, up to position
+        self.file.seek(self.hashed)
+        while self.hashed < position:
+            data = self.file.read(min(CATCH_UP_BUFFER_SIZE, position - self.hashed))
+            if not data:
+                break
+            self.hasher.update(data)
+            self.hashed += len(data)
+        self.file.seek(position)
+
+    def hexdigest(self):
+        # the hash of the whole file, whatever was read of it
+        position = self.file.tell()
+        self.catch_up(self.file.seek(0, os.SEEK_END))
+        self.file.seek(position)
+        return self.hasher.hexdigest()
+
+
+class HashingWriter:
+    def __init__(self, file, hasher=None):
+        self.file = file
+        self.hasher = hashlib.md5() if hasher is None else hasher
+        self.size = 0
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
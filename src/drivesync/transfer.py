@@ -0,0 +1,51 @@
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+class Transfer:
+    def __init__(self, description, action):
+        self.description = description
+        self.action = action
+
+class TransferScheduler:
+    """
+    Runs transfers with bounded concurrency. Transfers are grouped in stages,
+    stages run one after the other in sorted order and the transfers of a
+    stage run concurrently. A failing transfer does not stop the other
+    transfers of its stage, but no later stage is started.
+    Actions may return the number of bytes they transferred.
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.stages = collections.defaultdict(list)
+
+    def add(self, stage, description, action):
+        self.stages[stage].append(Transfer(description, action))
+
+    def run(self):
+        total = sum(len(transfers) for transfers in self.stages.values())
+        done = 0
+        transferred_bytes = 0
+        start = time.perf_counter()
+
+        with ThreadPoolExecutor(self.jobs) as pool:
+            for stage in sorted(self.stages):
+                futures = { pool.submit(t.action): t for t in self.stages[stage] }
+                error = None
+                for future in as_completed(futures):
+                    transfer = futures[future]
+                    done += 1
+                    try:
+                        transferred_bytes += future.result() or 0
+                        print(f"[{done}/{total}] {transfer.description}")
+                    except Exception as e:
+                        print(f"[{done}/{total}] {transfer.description} - failed: {e}")
+                        error = error or e
+                if error is not None:
+                    raise error
+
+        self.stages.clear()
+        elapsed = time.perf_counter() - start
+        if total > 0:
+            print(f"Transferred {total} entries, {transferred_bytes/1e6:.1f}MB in {elapsed:.1f}s ({transferred_bytes/1e6/max(elapsed, 1e-6):.2f}MB/s)")
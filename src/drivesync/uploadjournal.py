@@ -0,0 +1,51 @@
+import json
+import os
+import pathlib
+import threading
+from .common import Common
+
+class UploadJournal:
+    """
+    Records the resumable session of every upload in progress, with the number
+    of bytes already sent, so that an interrupted upload can be resumed by the
+    next push. A session is only resumed if the local file did not change since.
+    """
+
+    def __init__(self, journal_file):
+        self.journal_file = pathlib.Path(journal_file)
+        self.lock = threading.Lock()
+        self.sessions = {}
+        if self.journal_file.is_file():
+            try:
+                self.sessions = json.loads(self.journal_file.read_text())
+            except ValueError:
+                print(f"Ignoring corrupted upload journal {self.journal_file}")
+
+    @staticmethod
+    def file_key(local_file):
+        stat = os.stat(local_file)
+        return [str(pathlib.Path(local_file).resolve()), stat.st_size, stat.st_mtime_ns]
+
+    def get_session(self, upload_key, local_file):
+        with self.lock:
+            session = self.sessions.get(upload_key)
+        if session is None or session['file'] != UploadJournal.file_key(local_file):
+            return None
+        return session
+
+    def record(self, upload_key, local_file, session_uri, offset):
+        session = { 'file': UploadJournal.file_key(local_file), 'uri': session_uri, 'offset': offset }
+        with self.lock:
+            self.sessions[upload_key] = session
+            self.save()
+
+    def finish(self, upload_key):
+        with self.lock:
+            if self.sessions.pop(upload_key, None) is not None:
+                self.save()
+
+    def save(self):
+        if self.sessions:
+            Common.atomic_write(self.journal_file, json.dumps(self.sessions))
+        elif self.journal_file.exists():
+            self.journal_file.unlink()
@@ -0,0 +1,203 @@
+"""
+Linux inotify watcher, used by 'drivesync watch' to push changes as they happen.
+
+The watcher records the paths it sees changing in a dirty set, persisted next
+to the state file. As long as the watcher runs, that set holds every change
+made since the last sync and any push, from the watcher or not, only has to
+rescan those paths instead of the whole tree.
+"""
+
+import ctypes
+import ctypes.util
+import json
+import os
+import pathlib
+import select
+import struct
+from . import difftool
+from .common import Common
+from .exclusions import ExclusionMatcher
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+EVENT = struct.Struct('iIII')
+EVENTS_BUFFER_SIZE = 64 * 1024
+
+class DirtyPaths:
+    """
+    The persisted dirty set: the pid of the watcher maintaining it, whether it
+    is complete (no event was lost since the last full scan) and the paths.
+    Each path has the generation of the last event seen on it and each lost
+    event bumps the overflow count, so that a push only removes what did not
+    change again while it ran.
+    All accesses are serialized through a lock file, the watcher and pushes
+    may run in different processes.
+    """
+
+    def __init__(self, dirty_file):
+        self.dirty_file = pathlib.Path(dirty_file)
+        self.lock_file = self.dirty_file.with_name(self.dirty_file.name + '.lock')
+
+    def locked(self, update):
+        with open(self.lock_file, 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            content = { 'pid': None, 'complete': False, 'paths': {}, 'generation': 0, 'overflows': 0 }
+            if self.dirty_file.is_file():
+                content.update(json.loads(self.dirty_file.read_text()))
+            if isinstance(content['paths'], list):
+                # written before the paths had generations
+                content['paths'] = dict.fromkeys(content['paths'], 0)
+            result = update(content)
+            Common.atomic_write(self.dirty_file, json.dumps(content))
+            return result
+
+    @staticmethod
+    def is_valid(content):
+        if content['pid'] is None or not content['complete']:
+            return False
+        try:
+            os.kill(content['pid'], 0)
+            return True
+        except OSError:
+            return False
+
+    def start(self, pid):
+        def update(content):
+            content.update(pid=pid, complete=False, paths={})
+        self.locked(update)
+
+    def stop(self):
+        # the set is reset under the lock rather than removed, a push waiting for the lock would
+        # hold it on a removed lock file while the next one locks a new one. The lock file stays
+        def update(content):
+            content.update(pid=None, complete=False, paths={})
+        self.locked(update)
+
+    def add(self, paths, overflow=False):
+        def update(content):
+            content['generation'] += 1
+            content['paths'].update(dict.fromkeys(paths, content['generation']))
+            if overflow:
+                content['complete'] = False
+                content['overflows'] += 1
+        self.locked(update)
+
+    def take(self):
+        # returns the dirty paths, or None if they are not trustworthy and a full scan is needed,
+        # and what the push must give back to consumed() once it is done
+        if not self.dirty_file.is_file():
+            return (None, None)
+        def update(content):
+            taken = { 'pid': content['pid'], 'overflows': content['overflows'], 'paths': dict(content['paths']) }
+            return (sorted(content['paths']) if DirtyPaths.is_valid(content) else None, taken)
+        return self.locked(update)
+
+    def consumed(self, taken):
+        # removes the pushed paths that had no event since take(). After a full scan the set
+        # becomes complete again, unless events were lost or the watcher changed in the meantime
+        if taken is None or not self.dirty_file.is_file():
+            return
+        def update(content):
+            for (path, generation) in taken['paths'].items():
+                if content['paths'].get(path) == generation:
+                    del content['paths'][path]
+            if content['pid'] is not None and content['pid'] == taken['pid'] and content['overflows'] == taken['overflows']:
+                content['complete'] = True
+        self.locked(update)
+
+
+class Watcher:
+    def __init__(self, root, excluded):
+        self.root = str(root)
+        self.excluded = excluded
+        self.matcher = ExclusionMatcher.compile(tuple(excluded))
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        self.overflow = False
+        self.watch_tree('')
+
+    def close(self):
+        os.close(self.fd)
+
+    def watch_tree(self, rel_dir):
+        self.watch_directory(rel_dir)
+        for (rel_path, path, is_directory) in difftool.walk_local_files(self.root, self.excluded, rel_dir):
+            if is_directory and not os.path.islink(path):
+                self.watch_directory(rel_path)
+
+    def watch_directory(self, rel_dir):
+        path = os.path.join(self.root, rel_dir)
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            # the directory may already be gone, or the watch limit reached, in which case
+            # changes can be missed and the next push must rescan everything
+            print(f"Cannot watch {path}: {os.strerror(error)}")
+            self.overflow = True
+            return
+        self.watches[wd] = rel_dir
+
+    def unwatch_tree(self, rel_dir):
+        for (wd, watched) in list(self.watches.items()):
+            if difftool.is_under(watched, {rel_dir}):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def read_events(self, timeout):
+        # waits up to timeout seconds for events, returns the changed paths and
+        # whether events were lost
+        (readable, _, _) = select.select([self.fd], [], [], timeout)
+        paths = set()
+        while readable:
+            try:
+                buffer = os.read(self.fd, EVENTS_BUFFER_SIZE)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buffer):
+                (wd, mask, cookie, name_length) = EVENT.unpack_from(buffer, offset)
+                name = os.fsdecode(buffer[offset+EVENT.size:offset+EVENT.size+name_length].rstrip(b'\0'))
+                offset += EVENT.size + name_length
+                self.handle_event(wd, mask, name, paths)
+
+        (overflow, self.overflow) = (self.overflow, False)
+        return (paths, overflow)
+
+    def handle_event(self, wd, mask, name, paths):
+        if mask & IN_Q_OVERFLOW:
+            self.overflow = True
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+        if wd not in self.watches or not name:
+            return
+        rel_dir = self.watches[wd]
+        rel_path = name if rel_dir == '' else os.path.join(rel_dir, name)
+        if self.matcher.matches(rel_path):
+            return
+        paths.add(rel_path)
+        if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+            self.unwatch_tree(rel_path)
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            self.watch_tree(rel_path)